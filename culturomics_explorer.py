@@ -40,14 +40,30 @@ INFO='''
     Note to users -- known caveat: quotation marks are removed from the input query.
     '''
 
-def culturomics_explorer():
-    
+def culturomics_explorer(mode = 'gui', port = 8155, jobs_file = 'batch_jobs.tsv', workers = None, precision = None):
+
+    import matplotlib
+    if mode != 'gui':
+        #no display needed when plots are only rendered to png/svg
+        matplotlib.use('Agg')
     import matplotlib.pyplot as plt
-    import tkinter as tk
-    from tkinter import filedialog as fd
-    from tkinter import ttk
+    import numpy as np
+    import asyncio
+    import atexit
+    import base64
+    import collections
+    import hashlib
+    import heapq
+    import itertools
+    import json
+    import os
+    import struct
+    import tempfile
+    import threading
+    import time
+    import zlib
     import re
-    
+
     
     class PlotSettings (object):
         def __init__ (self, start, end, smooth):
@@ -244,6 +260,631 @@ def culturomics_explorer():
                 if element.corpus == self.corpus:
                     self.label = '\'' + self.label + '\'' + element.tag
                     break
+
+
+
+    class FigureCache (object):
+        def __init__ (self, directory = 'figure_cache', max_bytes = 256 * 1024 * 1024):
+            #rendered plot images saved to disk, named by a hash of everything that goes into the plot;
+            #once the images take more than max_bytes, the least recently used ones are deleted
+            self.directory = directory
+            self.max_bytes = max_bytes
+            self.lock = threading.Lock()
+
+
+        def key(self, terms, languages, bck_plot_object, plot_settings, image_format):
+            #hash of the terms and corpora, their ngram data, the background timespan as read from
+            #the timespan file, the plot settings, the image format and the matplotlib version
+
+            series = []
+            for term, corpus in zip(terms, languages):
+                ngram_object = find_in_master_set(term, corpus, plot_settings.smoothing)
+                series.append([term, corpus, ngram_object.label, [float(value) for value in ngram_object.data]])
+
+            plot_inputs = {'series': series, \
+                           'background': [bck_plot_object.name, bck_plot_object.dates, bck_plot_object.colors], \
+                           'settings': [plot_settings.start_year, plot_settings.end_year, plot_settings.smoothing], \
+                           'format': image_format, 'matplotlib': matplotlib.__version__}
+
+            return hashlib.sha256(json.dumps(plot_inputs, sort_keys = True).encode('utf-8')).hexdigest()
+
+
+        def path(self, key, image_format):
+            return os.path.join(self.directory, '{}.{}'.format(key, image_format))
+
+
+        def get(self, key, image_format):
+            #return the stored image, or None if it is not cached
+            try:
+                with self.lock:
+                    with open(self.path(key, image_format), mode = 'rb') as image_file:
+                        image = image_file.read()
+                    #mark as recently used for eviction
+                    os.utime(self.path(key, image_format))
+                return image
+            except OSError:
+                return None
+
+
+        def put(self, key, image_format, image):
+            #write to a temporary file first, so a half-written image is never read back; the
+            #temporary file has a name of its own, as other processes may write the same image
+            try:
+                with self.lock:
+                    os.makedirs(self.directory, exist_ok = True)
+                    descriptor, temp_path = tempfile.mkstemp(suffix = '.tmp', dir = self.directory)
+                    try:
+                        with os.fdopen(descriptor, mode = 'wb') as image_file:
+                            image_file.write(image)
+                        os.replace(temp_path, self.path(key, image_format))
+                    except OSError:
+                        os.remove(temp_path)
+                        raise
+                    self.evict()
+            except OSError:
+                pass
+
+
+        def evict(self):
+            #delete the least recently used images until the cache fits in max_bytes
+            cached = []
+            for entry in os.scandir(self.directory):
+                if entry.is_file() and not entry.name.endswith('.tmp'):
+                    info = entry.stat()
+                    cached.append((info.st_mtime, info.st_size, entry.path))
+
+            total_bytes = sum(size for used, size, path in cached)
+            for used, size, path in sorted(cached):
+                if total_bytes <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    #already evicted by another process
+                    pass
+                total_bytes -= size
+
+
+
+    class SeriesStoreFile (object):
+        def __init__ (self, file_name = 'ngrams_cache.dat', block_rows = 256, precision = None, \
+                      cache_bytes = 64 * 1024 * 1024):
+            #ngram data kept on disk between sessions, in blocks of up to block_rows series compressed
+            #with encode_series (to the given precision, or exactly if None).  a block is a header
+            #(marker, size of keys, size of data), the keys of its series as a json list of
+            #[term, corpus, smoothing, label], and the data.  blocks are only ever appended, so
+            #several sessions can share the file.  only the keys are read when the file is opened;
+            #the data of a block is decompressed when it is needed (for one of its series, or by a
+            #search going through the blocks), and up to cache_bytes of the blocks decompressed
+            #most recently are kept, so the stored series are never all in memory at once
+            self.file_name = file_name
+            self.block_rows = block_rows
+            self.precision = precision
+            self.cache_bytes = cache_bytes
+            self.lock = threading.Lock()
+            self.blocks = []    #(offset of data, size of data, [(key, label) per row]) per block
+            self.index = {}     #key -> (block, row)
+            self.pending = []   #series not yet written in a block
+            self.end = 0        #offset after the last complete block
+            self.decoded = collections.OrderedDict()    #block -> matrix, least recently used first
+            self.decoded_bytes = 0
+            self.read_index()
+
+
+        def read_index(self):
+            #index the blocks added to the file since it was last read, by this or another session
+            try:
+                with open(self.file_name, mode = 'rb') as store_file:
+                    self.scan(store_file)
+            except OSError:
+                pass
+
+
+        def scan(self, store_file):
+            file_size = os.fstat(store_file.fileno()).st_size
+            if file_size < self.end:
+                #the file was deleted or replaced, so start again with the new one
+                self.blocks = []
+                self.index = {}
+                self.end = 0
+                self.decoded.clear()
+                self.decoded_bytes = 0
+            store_file.seek(self.end)
+            while self.end + 12 <= file_size:
+                marker, keys_size, data_size = struct.unpack('<4sII', store_file.read(12))
+                data_offset = self.end + 12 + keys_size
+                if marker != b'CES1' or data_offset + data_size > file_size:
+                    #a block still being written, or left unfinished (which the next block written
+                    #replaces)
+                    break
+                self.index_block(store_file.read(keys_size), data_offset, data_size)
+                store_file.seek(data_size, 1)
+                self.end = data_offset + data_size
+
+
+        def index_block(self, keys, data_offset, data_size):
+            #a block whose keys cannot be read is skipped, like a bad line of the ngram log
+            try:
+                rows = [((term, corpus, int(smoothing)), label) for term, corpus, smoothing, label in json.loads(keys)]
+            except (ValueError, TypeError):
+                return
+
+            block = len(self.blocks)
+            for row, (key, label) in enumerate(rows):
+                self.index[key] = (block, row)
+            self.blocks.append((data_offset, data_size, rows))
+
+
+        def read_block(self, block):
+            #the matrix of a block's series, from the recently decompressed blocks if it is there
+            if block in self.decoded:
+                self.decoded.move_to_end(block)
+                return self.decoded[block]
+
+            data_offset, data_size, rows = self.blocks[block]
+            with open(self.file_name, mode = 'rb') as store_file:
+                store_file.seek(data_offset)
+                matrix = decode_series(store_file.read(data_size))
+            if len(matrix) != len(rows):
+                raise ValueError('block has {} series for {} keys'.format(len(matrix), len(rows)))
+
+            self.decoded[block] = matrix
+            self.decoded_bytes += matrix.nbytes
+            while self.decoded_bytes > self.cache_bytes and len(self.decoded) > 1:
+                self.decoded_bytes -= self.decoded.popitem(last = False)[1].nbytes
+            return matrix
+
+
+        def iterate(self, smoothing, batch_rows = 8192):
+            #the stored series with the given smoothing that are not in the master set (which is
+            #searched separately), about batch_rows at a time, as ([(key, label) per series],
+            #matrix with a row per series).  only the latest copy of a series stored more than
+            #once is given
+            with self.lock:
+                self.read_index()
+                block_count = len(self.blocks)
+
+            batch_keys, batch = [], []
+            for block in range(block_count):
+                with self.lock:
+                    if block >= len(self.blocks):
+                        #the file was replaced while the blocks were being read
+                        break
+                    rows = [(row, key, label) for row, (key, label) in enumerate(self.blocks[block][2]) \
+                            if key[2] == smoothing and self.index.get(key) == (block, row)]
+                    if len(rows) == 0:
+                        continue
+                    try:
+                        matrix = self.read_block(block)
+                    except (OSError, ValueError):
+                        continue
+                with ngrams_lock:
+                    rows = [(row, key, label) for row, key, label in rows if key not in ngrams_index]
+                if len(rows) == 0:
+                    continue
+
+                batch_keys += [(key, label) for row, key, label in rows]
+                batch.append(matrix[[row for row, key, label in rows]])
+                if len(batch_keys) >= batch_rows:
+                    yield batch_keys, np.concatenate(batch)
+                    batch_keys, batch = [], []
+
+            if len(batch_keys) > 0:
+                yield batch_keys, np.concatenate(batch)
+
+
+        def get(self, term, corpus, smoothing):
+            #the stored ngram object, or [] if the ngram is not in the store
+            with self.lock:
+                if (term, corpus, smoothing) not in self.index:
+                    #it may have been stored by another session since the file was last read
+                    self.read_index()
+                if (term, corpus, smoothing) not in self.index:
+                    return []
+                block, row = self.index[(term, corpus, smoothing)]
+                try:
+                    matrix = self.read_block(block)
+                except (OSError, ValueError):
+                    return []
+                return NGram(term, corpus, smoothing, self.blocks[block][2][row][1], matrix[row])
+
+
+        def add(self, ngram_object):
+            #only full series (the years 1900-2008) can be stored in a block
+            if len(ngram_object.data) != 109:
+                return
+            with self.lock:
+                self.pending.append(ngram_object)
+                if len(self.pending) >= self.block_rows:
+                    self.write_block()
+
+
+        def flush(self):
+            with self.lock:
+                if len(self.pending) > 0:
+                    self.write_block()
+
+
+        def write_block(self):
+            keys = json.dumps([[ngram_object.name, ngram_object.corpus, ngram_object.smoothing, ngram_object.label] \
+                               for ngram_object in self.pending]).encode('utf-8')
+            try:
+                data = encode_series([ngram_object.data for ngram_object in self.pending], self.precision)
+            except ValueError:
+                #series that cannot be encoded are dropped rather than kept back from every later block
+                self.pending = []
+                return
+            try:
+                with open(os.open(self.file_name, os.O_RDWR | os.O_CREAT, 0o644), mode = 'r+b') as store_file:
+                    #one session appends at a time (the lock is released when the file is closed),
+                    #after the blocks other sessions have appended since this one last looked
+                    try:
+                        import fcntl
+                        fcntl.flock(store_file, fcntl.LOCK_EX)
+                    except ImportError:
+                        #no fcntl on windows, where sessions sharing the file should not run at once
+                        pass
+                    self.scan(store_file)
+                    store_file.seek(self.end)
+                    store_file.write(struct.pack('<4sII', b'CES1', len(keys), len(data)) + keys + data)
+            except OSError:
+                return
+
+            self.index_block(keys, self.end + 12 + len(keys), len(data))
+            self.end += 12 + len(keys) + len(data)
+            self.pending = []
+
+
+    class SeriesMatrix (object):
+        def __init__ (self):
+            #the 1900-2008 data of every ngram in the master set with one smoothing, as a numpy
+            #matrix with a row per ngram.  the ngrams added to the master set since the last call
+            #are written into spare rows of the matrix in place (see reserve_rows), and the matrix
+            #is rebuilt when a different smoothing is asked for.  the data of each ngram in the
+            #matrix is then a view of its row, so the series are not held twice
+            self.smoothing = None
+            self.lock = threading.Lock()
+
+
+        def refresh(self, smoothing):
+            with self.lock:
+                if smoothing != self.smoothing:
+                    self.smoothing = smoothing
+                    self.objects = []
+                    self.indexed = 0
+                    self.matrix = np.empty((0, 109))
+
+                with ngrams_lock:
+                    new_objects = ngrams[self.indexed:]
+                self.indexed += len(new_objects)
+
+                new_objects = [ngram_object for ngram_object in new_objects \
+                               if ngram_object.smoothing == smoothing and len(ngram_object.data) == 109]
+                if new_objects:
+                    used = len(self.objects)
+                    matrix = reserve_rows(self.matrix, used, used + len(new_objects))
+                    for row, ngram_object in enumerate(new_objects, used):
+                        matrix[row] = ngram_object.data
+                    self.objects = self.objects + new_objects
+                    #if the matrix had to grow, the rows of the ngrams already in it have moved too
+                    for row in range(used if matrix is self.matrix else 0, len(self.objects)):
+                        self.objects[row].data = matrix[row]
+                    self.matrix = matrix
+
+                return self.objects, self.matrix[:len(self.objects)]
+
+
+
+    class TrajectoryIndex (object):
+        def __init__ (self, chunk_rows = 65536):
+            #the z-normalized data of every ngram in the master set over one plot settings window,
+            #kept as one matrix (a row per ngram) so a query is compared with all of them at once
+            #(the rest of the series store is compared a batch at a time, see search).  the matrix
+            #is rebuilt when the window or smoothing changes and is otherwise only extended in
+            #place with the ngrams added since the last search (see reserve_rows)
+            self.chunk_rows = chunk_rows
+            self.window = None
+            self.lock = threading.Lock()
+
+
+        def z_normalize(self, values):
+            #for a single series or a matrix of series, one per row; flat series become all zeros
+            deviation = values.std(axis = -1, keepdims = True)
+            deviation[deviation == 0] = 1.0
+            return (values - values.mean(axis = -1, keepdims = True)) / deviation
+
+
+        def refresh(self, plot_settings):
+            window = (plot_settings.start_year, plot_settings.end_year, plot_settings.smoothing)
+            x_start = plot_settings.start_year - 1900
+            x_end = plot_settings.end_year - 1900 + 1
+
+            with self.lock:
+                objects, series = series_matrix.refresh(plot_settings.smoothing)
+                if window != self.window:
+                    self.window = window
+                    self.rows = 0
+                    self.matrix = np.empty((0, x_end - x_start))
+                    self.squared_norms = np.empty(0)
+
+                #normalized a chunk at a time, so no temporary copy of all the new rows is made
+                self.matrix = reserve_rows(self.matrix, self.rows, len(series))
+                self.squared_norms = reserve_rows(self.squared_norms, self.rows, len(series))
+                for start in range(self.rows, len(series), self.chunk_rows):
+                    rows = self.z_normalize(series[start:start + self.chunk_rows, x_start:x_end])
+                    self.matrix[start:start + len(rows)] = rows
+                    self.squared_norms[start:start + len(rows)] = (rows ** 2).sum(axis = 1)
+                self.rows = len(series)
+
+                return objects, self.matrix[:self.rows], self.squared_norms[:self.rows]
+
+
+        def lb_keogh(self, query, matrix, band):
+            #lower bound of the dtw distance between the query and every row: how far each row
+            #falls outside the band of the highest and lowest query values within +-band years
+            padded = np.pad(query, band, mode = 'edge')
+            windows = np.lib.stride_tricks.sliding_window_view(padded, 2 * band + 1)
+            upper = windows.max(axis = 1)
+            lower = windows.min(axis = 1)
+
+            bounds = np.empty(len(matrix))
+            for start in range(0, len(matrix), self.chunk_rows):
+                chunk = matrix[start:start + self.chunk_rows]
+                bounds[start:start + len(chunk)] = (np.maximum(chunk - upper, 0) ** 2 + \
+                                                    np.maximum(lower - chunk, 0) ** 2).sum(axis = 1)
+            return np.sqrt(bounds)
+
+
+        def dtw(self, query, candidates, band):
+            #dynamic time warping distance from the query to each row of candidates, warping at
+            #most +-band years; each cell of the cost table is filled for all candidates at once
+            length = len(query)
+            previous = np.full((len(candidates), length + 1), np.inf)
+            previous[:, 0] = 0.0
+
+            for i in range(1, length + 1):
+                current = np.full((len(candidates), length + 1), np.inf)
+                for j in range(max(1, i - band), min(length, i + band) + 1):
+                    cost = (query[i - 1] - candidates[:, j - 1]) ** 2
+                    current[:, j] = cost + np.minimum(np.minimum(previous[:, j], previous[:, j - 1]), current[:, j - 1])
+                previous = current
+
+            return np.sqrt(previous[:, length])
+
+
+        def search(self, query_object, plot_settings, count = 10, measure = 'correlation'):
+            #the count ngrams (other than the query itself) whose z-normalized data over the plot
+            #settings window is closest to the query's, as a list of (distance, ngram object)
+            #measure is 'correlation' (1 - pearson r), 'euclidean' or 'dtw'.  the ngrams in the
+            #master set are compared first, then the rest of the series store a block at a time
+
+            if count < 1:
+                raise ValueError('the number of ngrams to find must be at least 1')
+            if measure not in ('correlation', 'euclidean', 'dtw'):
+                raise ValueError('unknown distance measure \'{}\''.format(measure))
+
+            objects, matrix, squared_norms = self.refresh(plot_settings)
+            x_start = plot_settings.start_year - 1900
+            x_end = plot_settings.end_year - 1900 + 1
+            query = self.z_normalize(np.array(query_object.data[x_start:x_end], dtype = float))
+            query_key = (query_object.name, query_object.corpus, query_object.smoothing)
+            wanted = count + 1  #+1 in case the query itself is among the closest
+            closest = []        #(distance, order found, ngram object) of the wanted closest so far
+            found = itertools.count()
+
+            def keep_closest(matrix, squared_norms, ngram_object):
+                #add the closest rows of the matrix to closest, ngram_object(row) giving their ngrams
+                worst_kept = closest[-1][0] if len(closest) == wanted else np.inf
+                distances = self.distances(query, matrix, squared_norms, min(wanted, len(matrix)), measure, worst_kept)
+                nearest = np.argpartition(distances, min(wanted, len(matrix)) - 1)[:wanted]
+                for index in nearest:
+                    if distances[index] < worst_kept:
+                        closest.append((float(distances[index]), next(found), ngram_object(index)))
+                closest[:] = sorted(closest)[:wanted]
+
+            if len(objects) > 0:
+                keep_closest(matrix, squared_norms, lambda index: objects[index])
+            for rows, series in series_store.iterate(plot_settings.smoothing):
+                block = self.z_normalize(series[:, x_start:x_end])
+                keep_closest(block, (block ** 2).sum(axis = 1), \
+                             lambda index: NGram(*rows[index][0], rows[index][1], series[index].copy()))
+
+            return [(distance, ngram_object) for distance, order, ngram_object in closest \
+                    if (ngram_object.name, ngram_object.corpus, ngram_object.smoothing) != query_key][:count]
+
+
+        def distances(self, query, matrix, squared_norms, wanted, measure, worst_kept = np.inf):
+            #distance from the query to every row of the matrix; for dtw only the rows that could
+            #be among the wanted closest, and closer than worst_kept, are measured (see dtw_distances)
+            if measure == 'correlation':
+                return 1.0 - matrix.dot(query) / len(query)
+            elif measure == 'euclidean':
+                return np.sqrt(np.maximum(squared_norms + query.dot(query) - 2.0 * matrix.dot(query), 0))
+            else:
+                return self.dtw_distances(query, matrix, wanted, worst_kept)
+
+
+        def dtw_distances(self, query, matrix, wanted, worst_kept = np.inf, batch_rows = 512):
+            #compute the dtw distance only for rows whose lower bound could still put them among
+            #the wanted closest rows (and closer than worst_kept, the distance already needed to be
+            #among them), a batch at a time in order of increasing lower bound; the distance of
+            #every row that is pruned is left as infinity
+            band = max(1, len(query) // 10)
+            bounds = self.lb_keogh(query, matrix, band)
+            order = np.argsort(bounds)
+            distances = np.full(len(matrix), np.inf)
+
+            for start in range(0, len(order), batch_rows):
+                batch = order[start:start + batch_rows]
+                batch = batch[bounds[batch] < worst_kept]
+                if len(batch) == 0:
+                    break
+                distances[batch] = self.dtw(query, matrix[batch], band)
+                worst_kept = min(worst_kept, np.partition(distances, wanted - 1)[wanted - 1])
+
+            return distances
+
+
+
+    class Prefetcher (object):
+        def __init__ (self, max_in_flight = 2, miss_expiry = 600):
+            #fetches ngrams in the background so they are already at hand when they are plotted.
+            #there is at most one pending fetch per slot (e.g. per ngram entry), so a fetch that is
+            #no longer wanted is cancelled if it has not started yet.  what is fetched is only kept
+            #in ngrams_prefetched (see fetch_ngram), as the entry may hold a half-typed term.
+            #ngrams with no data are not prefetched again for miss_expiry seconds
+            from concurrent.futures import ThreadPoolExecutor
+
+            self.pool = ThreadPoolExecutor(max_workers = max_in_flight)
+            self.pending = {}
+            self.missing = {}   #key -> time of the fetch that found no data
+            self.miss_expiry = miss_expiry
+
+
+        def prefetch(self, slot, term, corpus, smoothing):
+            self.cancel(slot)
+            key = (term, corpus, smoothing)
+            if find_in_master_set(term, corpus, smoothing) or key in ngrams_prefetched:
+                return
+            if time.monotonic() - self.missing.get(key, -self.miss_expiry) < self.miss_expiry:
+                return
+            self.pending[slot] = self.pool.submit(self.fetch, key)
+
+
+        def fetch(self, key):
+            if not fetch_ngram(*key, keep = False):
+                self.missing[key] = time.monotonic()
+
+
+        def cancel(self, slot):
+            #a fetch already under way is left to finish, as its data is still worth keeping
+            if slot in self.pending:
+                self.pending.pop(slot).cancel()
+
+
+
+    class SharedSeriesStore (object):
+        def __init__ (self, capacity, keys_capacity):
+            #the data of up to capacity ngrams in one block of shared memory, so that worker
+            #processes all read the same copy of each series instead of holding their own.  the
+            #block holds a header (rows stored, bytes of keys used), a matrix with 109 years per
+            #row, and the key (term, corpus, smoothing, label) of each row in order, in up to
+            #keys_capacity bytes (see key_record).  only the
+            #coordinating process inserts, and it counts a row in the header only after writing it
+            #and its key, so workers can read at any time without locking
+            from multiprocessing import shared_memory
+
+            self.capacity = capacity
+            self.keys_offset = 16 + capacity * 109 * 8
+            self.keys_capacity = keys_capacity
+            self.memory = shared_memory.SharedMemory(create = True, size = self.keys_offset + self.keys_capacity)
+            self.header = np.ndarray(2, dtype = np.int64, buffer = self.memory.buf)
+            self.header[:] = 0
+            self.matrix = np.ndarray((capacity, 109), dtype = np.float64, buffer = self.memory.buf, offset = 16)
+            #this process's copy of the key -> (row, label) table, see refresh
+            self.rows = {}
+            self.keys_read = 0
+
+
+        def refresh(self):
+            #add the keys of rows stored since the last refresh to this process's table
+            stored = int(self.header[0])
+            if stored == len(self.rows):
+                return
+            keys_used = int(self.header[1])
+            records = bytes(self.memory.buf[self.keys_offset + self.keys_read:self.keys_offset + keys_used])
+            for record in records.split(b'\n')[:stored - len(self.rows)]:
+                self.keys_read += len(record) + 1
+                term, corpus, smoothing, label = record.decode('utf-8').split('\t')
+                self.rows[(term, corpus, int(smoothing))] = (len(self.rows), label)
+
+
+        def insert(self, ngram_object):
+            #coordinating process only
+            self.refresh()
+            key = (ngram_object.name, ngram_object.corpus, ngram_object.smoothing)
+            if key in self.rows:
+                return
+
+            row = int(self.header[0])
+            keys_used = int(self.header[1])
+            record = key_record(ngram_object)
+            if row == self.capacity or keys_used + len(record) > self.keys_capacity:
+                raise ValueError('the shared series store is full')
+
+            self.matrix[row] = ngram_object.data
+            start = self.keys_offset + keys_used
+            self.memory.buf[start:start + len(record)] = record
+            self.header[1] = keys_used + len(record)
+            self.header[0] = row + 1
+
+
+        def get(self, term, corpus, smoothing):
+            #an ngram object whose data is a view of its row in shared memory (not a copy),
+            #or [] if the ngram is not stored
+            key = (term, corpus, smoothing)
+            if key not in self.rows:
+                self.refresh()
+            if key not in self.rows:
+                return []
+            row, label = self.rows[key]
+            return NGram(term, corpus, smoothing, label, self.matrix[row])
+
+
+        def close(self):
+            #coordinating process only, once the workers are done
+            self.header = None
+            self.matrix = None
+            self.memory.close()
+            self.memory.unlink()
+
+
+
+    class SeriesCoordinator (object):
+        def __init__ (self, store, context, workers, fetch_workers = 8):
+            #runs in the process that owns the shared store: workers put (worker, term, corpus,
+            #smoothing) on requests for ngrams that are not in the store yet, and get (True, None)
+            #on their own reply queue once the ngram is stored, (False, None) if there is no data
+            #for it, or (False, error message) if it could not be fetched or stored.
+            #the fetch goes through fetch_ngram, so an ngram is fetched only once however many
+            #workers ask for it
+            self.store = store
+            self.lock = threading.Lock()
+            #ngrams with no data are remembered too, so they are not asked for twice either
+            self.missing = set()
+            self.fetch_workers = fetch_workers
+            self.requests = context.Queue()
+            self.replies = [context.Queue() for worker in range(workers)]
+
+
+        def serve(self):
+            #answer requests until a None request arrives
+            from concurrent.futures import ThreadPoolExecutor
+
+            with ThreadPoolExecutor(max_workers = self.fetch_workers) as pool:
+                while True:
+                    request = self.requests.get()
+                    if request is None:
+                        break
+                    pool.submit(self.answer, *request)
+
+
+        def answer(self, worker, term, corpus, smoothing):
+            ngram_object = []
+            error = None
+            try:
+                if (term, corpus, smoothing) not in self.missing:
+                    ngram_object = fetch_ngram(term, corpus, smoothing)
+                with self.lock:
+                    if ngram_object:
+                        self.store.insert(ngram_object)
+                    else:
+                        self.missing.add((term, corpus, smoothing))
+            except Exception as failure:
+                error = '{}: {}'.format(type(failure).__name__, failure)
+            finally:
+                self.replies[worker].put((bool(ngram_object) and error is None, error))
+
                     
     class Application(object):
         def __init__(self, master, file_name = 'timespan_data.tsv', write_file = 'ngrams_data.tsv', \
@@ -274,11 +915,18 @@ def culturomics_explorer():
             self.file_menu = tk.Menu(self.menu_bar, tearoff = 0)
             self.file_menu.add_command(label = 'Timespan File', command = self.get_timespan_file)
             self.file_menu.add_command(label = 'Ngram log', command = self.get_ngrams_file)
+            self.compact_log = tk.BooleanVar(value = False)
+            self.file_menu.add_checkbutton(label = 'Compress ngram log data', variable = self.compact_log)
             self.menu_bar.add_cascade(label = 'Files', menu = self.file_menu)
             
             self.plot_menu = tk.Menu(self.menu_bar, tearoff = 0)
             self.plot_menu.add_command(label = 'Reset', command = self.get_plot_settings)
             self.menu_bar.add_cascade(label = 'Plot Settings', menu = self.plot_menu)
+
+            self.search_menu = tk.Menu(self.menu_bar, tearoff = 0)
+            self.search_menu.add_command(label = 'Similar trajectories', command = self.get_similar_terms)
+            self.search_menu.add_command(label = 'Rising and falling terms', command = self.get_era_terms)
+            self.menu_bar.add_cascade(label = 'Search', menu = self.search_menu)
                         
     
             #ngram text entry boxes
@@ -310,6 +958,15 @@ def culturomics_explorer():
             self.listboxes = [self.corp_listbox_1, self.corp_listbox_2, self.corp_listbox_3, self.corp_listbox_4, self.corp_listbox_5]
     
             self.populate_corpora()
+
+            #start fetching ngram data shortly after the user stops typing in an entry
+            #or selects its corpus, so it is usually loaded before 'plot ngrams' is pressed
+            self.prefetcher = Prefetcher()
+            self.prefetch_delay = 400 #ms
+            self.prefetch_timers = [None] * len(self.entries)
+            for index, (entry, corpus_listbox) in enumerate(zip(self.entries, self.listboxes)):
+                entry.bind('<KeyRelease>', lambda event, index = index: self.schedule_prefetch(index))
+                corpus_listbox.bind('<<ListboxSelect>>', lambda event, index = index: self.schedule_prefetch(index))
     
             #background plot selection
             ttk.Label(self.mainframe, text='background plot').grid(column = 1, row=3)
@@ -347,61 +1004,10 @@ def culturomics_explorer():
 
         def get_timespans(self):
             #read in data from tsv file, converting data into timespan objects for background plots
-            
-            mass_lst = []
-            temp_lst = []
-            line_count = 0
-            try:
-                with open(self.timespan_file) as timespan_data:
-                    for line in timespan_data:
-                        temp_lst = line.split('\t')
-                        mass_lst.append(temp_lst)
-                        line_count += 1
-            except:
-                pass
-            
-            #append '\n' to end of data so algorithm will process the last block of timespan data in the file
-            mass_lst.append('\n')
 
-            
-            object_line = 0
-            temp_lst = []
-            object_data = []
-            created_timespans = [Timespan('none', [])]
             self.options_list = [] #reset to nill in case previously populated
-            
-            
-            if len(mass_lst) != 0: 
-                for line in mass_lst:
-                    if len(line) == 1:  
-                        #line that is ['\n'] is break between timespan objects, so instantiate Timespan with collected info
-                        #and reset the variables to collect info for next timespan
-                        if len(temp_lst) != 1:
-                            created_timespans.append(Timespan(give_name, object_data))
-                            #created_timespans.append('new')
-                            #created_timespans[created_timespans.index('new')] = Timespan(give_name, object_data)
-                        give_name, object_data, object_line = '', [], 0
-    
-                    else:
-                        #collect info for non-break lines; object_line = 0 is first line 
-                        #with labels and contains no type int dates
-                        for element in line:
-                            if object_line is 0:
-                                if line.index(element) == 0:
-                                    give_name = element
-                                temp_lst.append(element.rstrip('\n'))
-                            else:
-                                if line.index(element) == 0:
-                                    temp_lst.append(element)
-                                else:
-                                    temp_lst.append(int(element.rstrip('\n')))
-                        object_line += 1
-                        object_data.append(temp_lst)
-                        temp_lst = []
-    
-    
-            self.timespan_objects = created_timespans    
-            
+            self.timespan_objects = read_timespans(self.timespan_file)
+
             for timespan in self.timespan_objects:
                 self.options_list.append(timespan.name)
                 
@@ -424,6 +1030,7 @@ def culturomics_explorer():
         def get_ngrams_file(self): 
             try:
                 self.write_file_name = fd.askopenfilename()
+                read_ngram_log(self.write_file_name)
             except:
                 pass
             
@@ -473,49 +1080,266 @@ def culturomics_explorer():
                     value = setting
                 values.append(int(value))
 
-            #make sure start year is before end year,  and that start year is
-            #not before 1900 and end year is not after 2008
-            if values[0] > values[1]:
-                values[0], values[1] = values[1], values[0]
-            
-            if values[0] < 1900:
-                values[0] = 1900
-                
-            if values[1] > 2008:
-                values[1] = 2008
-            
-            self.plot_settings = PlotSettings(values[0], values[1], values[2])
-            
+            self.plot_settings = make_plot_settings(values[0], values[1], values[2])
+
             self.reset_plot.destroy()
-                    
-            
-        def validate_input(self, term_to_check):
-            #the url call to google ngrams will not search certain character
-            #these chars (and leading and trailing whitespace) are removed
-        
-            not_searchable_parentheses = [',', '\'', '\"', ':', ';', '[', ']', '<', '>']
-            not_searchable = not_searchable_parentheses + ['+', '*', '.']
-            formatted_term = ''
-            found = []
-        
-            if term_to_check[0] == '(':
-                compare_set =  not_searchable_parentheses
+
+
+        def get_similar_terms(self):
+            #second window for finding the stored ngrams whose usage over the current plot
+            #settings window most resembles that of a query
+            self.similar = tk.Toplevel(self.master)
+            self.similar.transient(self.master)
+            self.similar.resizable(width = tk.FALSE, height = tk.FALSE)
+            self.similar_neighbours = []
+
+
+            self.similarframe = ttk.Frame(self.similar, padding='6 6 24 24')
+            self.similarframe.grid(column= 0, row=0, sticky=(tk.N, tk.W, tk.E, tk.S))
+            self.similarframe.columnconfigure(0, weight=1)
+            self.similarframe.rowconfigure(0, weight=1)
+
+
+            ttk.Label(self.similarframe, text = 'ngram').grid(column = 1, row = 1, sticky=(tk.W))
+            ttk.Label(self.similarframe, text = 'corpus').grid(column = 1, row = 2, sticky=(tk.W))
+            ttk.Label(self.similarframe, text = 'distance').grid(column = 1, row = 3, sticky=(tk.W))
+            ttk.Label(self.similarframe, text = 'number of terms\n(default 10)').grid(column = 1, row = 6, sticky=(tk.W))
+
+            self.similar_query = ttk.Entry(self.similarframe, width = 15)
+            self.similar_query.grid(column = 2, row = 1, sticky=(tk.W))
+            self.similar_corpus = ttk.Combobox(self.similarframe, width = 12, state = 'readonly', \
+                                               values = [element.name for element in corpora])
+            self.similar_corpus.current(0)
+            self.similar_corpus.grid(column = 2, row = 2, sticky=(tk.W))
+            self.similar_measure = tk.StringVar(value = 'correlation')
+            for row, measure in zip(range(3, 6), ['correlation', 'euclidean', 'dtw']):
+                ttk.Radiobutton(self.similarframe, text = measure, variable = self.similar_measure, \
+                                value = measure).grid(column = 2, row = row, sticky=(tk.W))
+            self.similar_count = ttk.Entry(self.similarframe, width = 3)
+            self.similar_count.grid(column = 2, row = 6, sticky=(tk.W))
+
+            ttk.Button(self.similarframe, text = 'search', command = self.find_similar_terms).grid(column = 1, row = 7)
+
+            self.similar_results = tk.Listbox(self.similarframe, width = 35, height = 10, selectmode = tk.MULTIPLE, \
+                                              exportselection = 0)
+            self.similar_results.grid(column = 1, row = 8, columnspan = 2, sticky = (tk.W, tk.E))
+            self.similar_lbl = tk.StringVar()
+            ttk.Label(self.similarframe, textvariable = self.similar_lbl).grid(column = 1, row = 9, columnspan = 2, \
+                                                                              sticky = (tk.W, tk.E))
+            ttk.Button(self.similarframe, text = 'plot selected', command = self.plot_similar_terms).grid(column = 1, \
+                                                                                                        row = 10)
+
+
+            for child in self.similarframe.winfo_children(): child.grid_configure(padx = 5, pady=5)
+            self.similar.bind('<Return>', self.find_similar_terms)
+
+
+        def find_similar_terms(self, *args):
+            self.similar_results.delete(0, tk.END)
+            self.similar_lbl.set('')
+            self.similar_neighbours = []
+
+            query = self.similar_query.get()
+            if len(query.strip()) > 0:
+                query = self.validate_input(query)[0]
+            if len(query.strip()) == 0:
+                self.similar_lbl.set('nothing entered to search')
+                return
+            corpus = corpora[self.similar_corpus.current()].corpus
+
+            count = self.similar_count.get()
+            if len(count) == 0:
+                count = 10
+
+            self.similar_query_object = fetch_ngram(query, corpus, self.plot_settings.smoothing)
+            if not self.similar_query_object:
+                self.similar_lbl.set('no data found for \'{}\' in {}'.format(query, corpus))
+                return
+
+            try:
+                self.similar_neighbours = trajectory_index.search(self.similar_query_object, self.plot_settings, \
+                                                                  int(count), self.similar_measure.get())
+            except ValueError as error:
+                self.similar_lbl.set(str(error))
+                return
+            for distance, ngram_object in self.similar_neighbours:
+                self.similar_results.insert(tk.END, '{}  {:.3f}'.format(ngram_object.label, distance))
+
+            if len(self.similar_neighbours) == 0:
+                self.similar_lbl.set('no other stored ngrams to compare with')
             else:
-                compare_set =  not_searchable
-        
-            for letter in term_to_check:     
-                if letter in compare_set:
-                    found.append(letter)
-                else:
-                    formatted_term = formatted_term + letter
-    
-            formatted_term = formatted_term.strip(' ')
-    
-            #replace any number of spaces >1 with a single space
-            space = re.compile( '  +' ) 
-            formatted_term = space.sub(' ', formatted_term)
-    
-            return formatted_term, found
+                self.similar_lbl.set('select up to 4 terms to plot with \'{}\''.format(query))
+
+
+        def plot_similar_terms(self):
+            #plot the query with the selected neighbours
+            chosen = [self.similar_neighbours[index][1] for index in self.similar_results.curselection()]
+            if len(chosen) == 0:
+                return
+
+            self.similar.destroy()
+            self.send_to_plot([self.similar_query_object] + chosen)
+
+
+        def get_era_terms(self):
+            #second window for ranking the stored ngrams by how much they rose or fell during
+            #an era of a background plot
+            self.era_window = tk.Toplevel(self.master)
+            self.era_window.transient(self.master)
+            self.era_window.resizable(width = tk.FALSE, height = tk.FALSE)
+            self.era_results = [[], []]
+
+
+            self.eraframe = ttk.Frame(self.era_window, padding='6 6 24 24')
+            self.eraframe.grid(column= 0, row=0, sticky=(tk.N, tk.W, tk.E, tk.S))
+            self.eraframe.columnconfigure(0, weight=1)
+            self.eraframe.rowconfigure(0, weight=1)
+
+
+            ttk.Label(self.eraframe, text = 'background plot').grid(column = 1, row = 1, sticky=(tk.W))
+            ttk.Label(self.eraframe, text = 'era').grid(column = 1, row = 2, sticky=(tk.W))
+            ttk.Label(self.eraframe, text = 'baseline years\n(default: the years\nbefore the era)').grid(column = 1, \
+                                                                                                     row = 3, sticky=(tk.W))
+            ttk.Label(self.eraframe, text = 'number of terms\n(default 10)').grid(column = 1, row = 4, sticky=(tk.W))
+
+            self.era_background = ttk.Combobox(self.eraframe, width = 30, state = 'readonly', \
+                                               values = self.options_list[1:])
+            self.era_background.grid(column = 2, row = 1, columnspan = 2, sticky=(tk.W))
+            self.era_background.bind('<<ComboboxSelected>>', self.list_eras)
+            self.era_choice = ttk.Combobox(self.eraframe, width = 30, state = 'readonly')
+            self.era_choice.grid(column = 2, row = 2, columnspan = 2, sticky=(tk.W))
+            self.era_base_start = ttk.Entry(self.eraframe, width = 4)
+            self.era_base_start.grid(column = 2, row = 3, sticky=(tk.W))
+            self.era_base_end = ttk.Entry(self.eraframe, width = 4)
+            self.era_base_end.grid(column = 3, row = 3, sticky=(tk.W))
+            self.era_count = ttk.Entry(self.eraframe, width = 3)
+            self.era_count.grid(column = 2, row = 4, sticky=(tk.W))
+
+            ttk.Button(self.eraframe, text = 'scan', command = self.scan_era_terms).grid(column = 1, row = 5)
+
+            ttk.Label(self.eraframe, text = 'rising').grid(column = 1, row = 6, sticky=(tk.W))
+            ttk.Label(self.eraframe, text = 'falling').grid(column = 2, row = 6, columnspan = 2, sticky=(tk.W))
+            self.era_rising = tk.Listbox(self.eraframe, width = 25, height = 10, selectmode = tk.MULTIPLE, \
+                                         exportselection = 0)
+            self.era_rising.grid(column = 1, row = 7)
+            self.era_falling = tk.Listbox(self.eraframe, width = 25, height = 10, selectmode = tk.MULTIPLE, \
+                                          exportselection = 0)
+            self.era_falling.grid(column = 2, row = 7, columnspan = 2)
+            self.era_lbl = tk.StringVar()
+            ttk.Label(self.eraframe, textvariable = self.era_lbl).grid(column = 1, row = 8, columnspan = 3, \
+                                                                      sticky = (tk.W, tk.E))
+            ttk.Button(self.eraframe, text = 'plot selected', command = self.plot_era_terms).grid(column = 1, row = 9)
+
+
+            for child in self.eraframe.winfo_children(): child.grid_configure(padx = 5, pady=5)
+            self.era_window.bind('<Return>', self.scan_era_terms)
+
+
+        def list_eras(self, *args):
+            #fill the era choices with the spans of the chosen background plot
+            timespan = self.timespan_objects[self.options_list.index(self.era_background.get())]
+            self.era_choice['values'] = [era[0] for era in timespan.dates[1:]]
+            if len(timespan.dates) > 1:
+                self.era_choice.current(0)
+
+
+        def scan_era_terms(self, *args):
+            self.era_rising.delete(0, tk.END)
+            self.era_falling.delete(0, tk.END)
+            self.era_lbl.set('')
+            self.era_results = [[], []]
+
+            if self.era_choice.current() < 0:
+                self.era_lbl.set('choose a background plot and an era')
+                return
+            timespan = self.timespan_objects[self.options_list.index(self.era_background.get())]
+            era = timespan.dates[1:][self.era_choice.current()]
+
+            baseline = None
+            if len(self.era_base_start.get()) > 0 and len(self.era_base_end.get()) > 0:
+                baseline = (int(self.era_base_start.get()), int(self.era_base_end.get()))
+
+            count = self.era_count.get()
+            if len(count) == 0:
+                count = 10
+
+            try:
+                self.era_results = scan_era(era, self.plot_settings.smoothing, int(count), baseline)
+            except ValueError as error:
+                self.era_lbl.set(str(error))
+                return
+
+            for listbox, ranked in zip([self.era_rising, self.era_falling], self.era_results):
+                for change, ngram_object in ranked:
+                    listbox.insert(tk.END, '{}  {:+.2f}'.format(ngram_object.label, change))
+
+            if len(self.era_results[0]) + len(self.era_results[1]) == 0:
+                self.era_lbl.set('no stored ngrams changed during {}'.format(era[0]))
+            else:
+                self.era_lbl.set('change is log2 of the ratio of mean frequencies;\nselect up to 5 terms to plot')
+
+
+        def plot_era_terms(self):
+            #plot the selected terms against the background plot the era is from
+            chosen = [self.era_results[0][index][1] for index in self.era_rising.curselection()] + \
+                     [self.era_results[1][index][1] for index in self.era_falling.curselection()]
+            if len(chosen) == 0:
+                return
+
+            bck_plot = self.era_background.get()
+            self.era_window.destroy()
+            self.send_to_plot(chosen, bck_plot)
+
+
+        def send_to_plot(self, ngram_objects, bck_plot = None):
+            #fill the ngram entries and corpus selections of the main window with up to five ngrams,
+            #select the background plot if one is given, and plot them
+            corpus_names = [element.corpus for element in corpora]
+            for entry, corpus_listbox in zip(self.entries, self.listboxes):
+                entry.delete(0, tk.END)
+                corpus_listbox.selection_clear(0, tk.END)
+
+            for ngram_object, entry, corpus_listbox in zip(ngram_objects, self.entries, self.listboxes):
+                entry.insert(0, ngram_object.name)
+                corpus_listbox.selection_set(corpus_names.index(ngram_object.corpus))
+
+            if bck_plot is not None:
+                self.background.selection_clear(0, tk.END)
+                self.background.selection_set(self.options_list.index(bck_plot))
+
+            self.plot_ngrams()
+
+
+        def schedule_prefetch(self, index):
+            #restart the wait every time the entry or its corpus changes, and drop any
+            #fetch still waiting for what was there before
+            if self.prefetch_timers[index] is not None:
+                self.master.after_cancel(self.prefetch_timers[index])
+            self.prefetcher.cancel(index)
+            self.prefetch_timers[index] = self.master.after(self.prefetch_delay, self.prefetch, index)
+
+
+        def prefetch(self, index):
+            #validate the entry the same way as plot_ngrams does, and fetch it in the background
+            self.prefetch_timers[index] = None
+
+            term = self.entries[index].get()
+            if len(term.strip()) == 0:
+                return
+            term = self.validate_input(term)[0]
+            if len(term) == 0:
+                return
+
+            if self.listboxes[index].curselection():
+                corpus = corpora[self.listboxes[index].curselection()[0]].corpus
+            else:
+                corpus = 'eng_us_2012'
+
+            self.prefetcher.prefetch(index, term, corpus, self.plot_settings.smoothing)
+
+
+        def validate_input(self, term_to_check):
+            return validate_term(term_to_check)
 
 
         def plot_ngrams(self, *args):
@@ -564,7 +1388,7 @@ def culturomics_explorer():
     
                 ###CALL TO PLOT###
                 plot_success = plot_ngrams_against(queries, corpora_selected, bck_plot_object, self.write_file_name, \
-                                                  self.plot_settings)  
+                                                  self.plot_settings, self.compact_log.get())
         
                 if plot_success != 'none':
                     self.success_lbl.set('no data found for {}'.format(', '.join(plot_success)))
@@ -583,221 +1407,1215 @@ def culturomics_explorer():
         Corpus('French', 'fre_2012', 19, '(Fre)'), Corpus('Spanish', 'spa_2012', 21, '(Spa)'), \
         Corpus('Italian', 'ita_2012', 22, '(Ita)'), Corpus('Hebrew', 'heb_2012', 24, '(Heb)'), \
         Corpus('Russian', 'rus_2012', 25, '(Rus)'), Corpus('Chinese', 'chi_2012', 23, '(Chi)')]
-                    
+    ngrams_index = {}
+    ngrams_logged = {}  #ngram log file name -> keys of the ngrams written to or read from it
+    ngrams_lock = threading.Lock()
+    ngrams_fetching = {}
+    ngrams_prefetched = {}
+    ngrams_prefetched_max = 64  #the oldest ngrams_prefetched are dropped beyond this many
+    figure_cache = FigureCache()
+    #ngram data is compressed exactly, or if precision is given, with every value rounded to within
+    #precision times the largest value of its series (see encode_series)
+    if precision is not None and not 0 < precision < 1:
+        raise ValueError('precision must be between 0 and 1')
+    series_store = SeriesStoreFile(precision = precision)
+    atexit.register(series_store.flush)
+    series_matrix = SeriesMatrix()
+    trajectory_index = TrajectoryIndex()
 
 
-    def plot_ngrams_against(terms, languages, bck_plot_object, write_file_name, plot_settings): 
-        #using ngram terms, chosen corpora, and background plot from GUI, determined
-        #if ngram data exists for the given entries, and if so plot it 
-        #retrieved ngram data is for 1900-2008, smoothing 5
-        #if return for a query is [0], no ngram found & don't append data; then 
-        #delete term and corpus at the appropriate index in respective lists
-        
-        not_found = []
-        successful_terms_corpora = [[], []]
-        
-        
-        def find_in_master_set(term, corpus):
-            #find a term, corpus pair in the master list of ngrams already searched in the session
 
-            found = []
+    def read_timespans(file_name):
+        #read in data from tsv file, converting data into timespan objects for background plots
+        #the first object is always the 'none' background
 
-            if len(ngrams) > 0:
-                for object_saved in ngrams:
-                    if term == object_saved.name and corpus == object_saved.corpus and \
-                    plot_settings.smoothing == object_saved.smoothing:
-                        found = object_saved
-                        break
+        mass_lst = []
+        temp_lst = []
+        line_count = 0
+        try:
+            with open(file_name) as timespan_data:
+                for line in timespan_data:
+                    temp_lst = line.split('\t')
+                    mass_lst.append(temp_lst)
+                    line_count += 1
+        except:
+            pass
 
-            return found  
-        
+        #append '\n' to end of data so algorithm will process the last block of timespan data in the file
+        #(only if something was read, otherwise the only background is 'none')
+        if len(mass_lst) != 0:
+            mass_lst.append('\n')
 
-        def set_max_min(terms, languages, plot_settings):
-            #set the y-axis max to be more than the greatest value in the data
-            #if data minimum < 0, set y-axis min to be less than the minimum
-            #value in the data by at least 10% of min value
 
-            maximum = 0.0
-            minimum = 0.0
-            
-            x_start = plot_settings.start_year - 1900
-            x_end = plot_settings.end_year - 1900 + 1
+        object_line = 0
+        temp_lst = []
+        object_data = []
+        created_timespans = [Timespan('none', [])]
 
-            for term, corpus in zip(terms, languages):
-                ngram_object = find_in_master_set(term, corpus)
-                if max(ngram_object.data[x_start:x_end]) >= maximum: 
-                    maximum = max(ngram_object.data[x_start:x_end])
-                if min(ngram_object.data[x_start:x_end]) <= minimum:
-                    minimum = min(ngram_object.data[x_start:x_end])
 
-            if abs(minimum) > abs(maximum):
-                margin = abs(minimum)/10
-            else: 
-                margin = maximum/10
-            maximum += margin
+        if len(mass_lst) != 0:
+            for line in mass_lst:
+                if len(line) == 1:
+                    #line that is ['\n'] is break between timespan objects, so instantiate Timespan with collected info
+                    #and reset the variables to collect info for next timespan
+                    if len(temp_lst) != 1:
+                        created_timespans.append(Timespan(give_name, object_data))
+                    give_name, object_data, object_line = '', [], 0
 
-            if minimum != 0:
-                minimum -= margin
+                else:
+                    #collect info for non-break lines; object_line = 0 is first line
+                    #with labels and contains no type int dates
+                    for element in line:
+                        if object_line == 0:
+                            if line.index(element) == 0:
+                                give_name = element
+                            temp_lst.append(element.rstrip('\n'))
+                        else:
+                            if line.index(element) == 0:
+                                temp_lst.append(element)
+                            else:
+                                temp_lst.append(int(element.rstrip('\n')))
+                    object_line += 1
+                    object_data.append(temp_lst)
+                    temp_lst = []
 
-            return minimum, maximum
+        return created_timespans
 
 
+    def make_plot_settings(start, end, smooth):
+        #make sure start year is before end year,  and that start year is
+        #not before 1900 and end year is not after 2008
 
-        def plotting(terms, languages, bck_plot_object, write_file_name, plot_settings): 
-            #create plot if there is data to plot (i.e. at least one query returned ngram data)
+        if start > end:
+            start, end = end, start
 
-            import matplotlib.axis as axis
-            from mpl_toolkits.axes_grid1 import make_axes_locatable
+        if start < 1900:
+            start = 1900
 
-            plt.clf()
+        if end > 2008:
+            end = 2008
 
-            min_val, max_val = set_max_min(terms, languages, plot_settings)
-            plt.axis([plot_settings.start_year, plot_settings.end_year, min_val, max_val])
+        return PlotSettings(start, end, smooth)
 
-            for ngram_object in ngrams:
-                try:
-                    with open(write_file_name, mode = 'a') as ngrams_file:
-                        ngrams_file.write(('{}\t{}\t').format(ngram_object.name, ngram_object.corpus) + \
-                                            '{}\t{}\t{}\n'.format(ngram_object.smoothing, ngram_object.label, ngram_object.data))
-                except:
-                    pass
 
+    def validate_term(term_to_check):
+        #the url call to google ngrams will not search certain character
+        #these chars (and leading and trailing whitespace) are removed, as are
+        #control characters such as tabs and newlines, which would break the logs
 
-            #plot the chosen background timespan info
-            main_plot = plt.subplot(1, 1, 1)
-            timespan_name = bck_plot_object.name    
-            if timespan_name != 'none': 
-                bck_plot_object.plot()
-                plt.subplots_adjust(bottom=0.17, right=0.76, top=0.92, left = 0.09)
+        not_searchable_parentheses = [',', '\'', '\"', ':', ';', '[', ']', '<', '>']
+        not_searchable = not_searchable_parentheses + ['+', '*', '.']
+        formatted_term = ''
+        found = []
+
+        if term_to_check[0] == '(':
+            compare_set =  not_searchable_parentheses
+        else:
+            compare_set =  not_searchable
+
+        for letter in term_to_check:
+            if letter in compare_set or not letter.isprintable():
+                found.append(letter)
             else:
-                plt.axvspan(1900, 2008, color = 'grey', alpha = .2)
-                for year in range(1900, 2010, 5):
-                    plt.axvline(year, color = 'white', alpha = .7)
-                plt.subplots_adjust(bottom=0.09, right=0.76, top=0.92, left = 0.09)
+                formatted_term = formatted_term + letter
 
+        formatted_term = formatted_term.strip(' ')
 
-            #if there is negative data, plot horizontal line at y = 0.0
-            if min_val < 0.0:
-                plt.axhline(0.0, color = 'black', alpha = .5, linewidth = 0.5)
+        #replace any number of spaces >1 with a single space
+        space = re.compile( '  +' )
+        formatted_term = space.sub(' ', formatted_term)
 
+        return formatted_term, found
 
-            #plot the data for the years 1900-2008
-            colors = ['black', 'blue', 'green', 'red', 'indigo']
-            for queried_term, queried_corpus, plot_color in zip(terms, languages, colors):
-                for object_saved in ngrams:
-                    if queried_term == object_saved.name and queried_corpus == object_saved.corpus and \
-                    plot_settings.smoothing == object_saved.smoothing:
-                        plt.plot(range(1900, 2009), object_saved.data, label = object_saved.label, \
-                                    color = plot_color, linewidth = 2.0)
-                        break
 
+    def encode_series(matrix, precision = None):
+        #compress a block of series (a matrix with a row per series).  without a precision the
+        #values are kept exactly: the bits of each value are xor-ed with the previous year's,
+        #which leaves mostly zero bytes for a slowly changing series.  with a precision each
+        #series is rounded to multiples of precision * its largest absolute value, so that no
+        #value is off by more than half of that, and stored as the differences between
+        #successive multiples.  either way the bytes are then grouped by their position within
+        #the values and compressed with zlib
 
-            #create title and legend for main plot
-            if timespan_name == 'none':
-                plt.title('Ngrams {}-{}'.format(plot_settings.start_year, plot_settings.end_year))
-            else:
-                plt.title('Ngrams and {}'.format(timespan_name))
-            plt.ylabel('% of ngrams')
-            plt.legend(bbox_to_anchor=(1.01, 1), loc=2, borderaxespad=0.2)
+        matrix = np.array(matrix, dtype = np.float64, ndmin = 2)
+        rows, columns = matrix.shape
 
+        if precision is None:
+            bits = matrix.view(np.uint64)
+            words = bits.copy()
+            words[:, 1:] ^= bits[:, :-1]
+            steps = b''
+        else:
+            steps = precision * np.abs(matrix).max(axis = 1)
+            steps[steps == 0] = 1.0
+            levels = np.rint(matrix / steps[:, None]).astype(np.int64)
+            differences = np.diff(levels, axis = 1, prepend = 0)
+            #zigzag, so that small negative differences also have mostly zero bytes
+            words = ((differences << 1) ^ (differences >> 63)).view(np.uint64)
+            steps = steps.tobytes()
 
-            #if background data plotted, create bar with timespan info beneath main plot
-            if timespan_name is not 'none':
-                divider = make_axes_locatable(main_plot)
-                box = divider.append_axes('bottom', size = '5%', pad=0.25)  
-                bck_plot_object.plot() 
-                box.axes.get_yaxis().set_visible(False)
-                tick_info = bck_plot_object.get_labels()
-                box.set_xticks(tick_info[1])
-                box.set_xticklabels(tick_info[0], rotation = 45, ha = 'right')
-                plt.axis([plot_settings.start_year, plot_settings.end_year, 0, 1])
-                box.tick_params(axis = u'both', which = u'both', length = 0) 
+        grouped = words.view(np.uint8).reshape(-1, 8).T.tobytes()
+        header = struct.pack('<BII', 0 if precision is None else 1, rows, columns)
+        return header + steps + zlib.compress(grouped, 6)
 
-            plt.show()
 
+    def decode_series(encoded):
+        #the matrix of series compressed by encode_series
 
+        try:
+            quantized, rows, columns = struct.unpack('<BII', encoded[:9])
+            position = 9
+            if quantized:
+                steps = np.frombuffer(encoded, dtype = np.float64, count = rows, offset = position)
+                position += rows * 8
+            grouped = np.frombuffer(zlib.decompress(encoded[position:]), dtype = np.uint8)
+        except (struct.error, zlib.error):
+            raise ValueError('not a block of encoded series')
+        if quantized not in (0, 1) or len(grouped) != rows * columns * 8:
+            raise ValueError('not a block of encoded series')
 
-        def getNgrams(query, corpus, startYear, endYear, smoothing):
-            #getNgrams py3 update adapted for plot_ngram_against()
-            #parse the query to format for url, convert the returned binary data to a 
-            #string, and then find and return the ngram data as a list
-            #NB: in py3 urllib request read() returns binary data that must be decoded to utf-8
+        words = grouped.reshape(8, rows * columns).T.copy().view(np.uint64).reshape(rows, columns)
+        if not quantized:
+            return np.bitwise_xor.accumulate(words, axis = 1).view(np.float64)
 
-            import urllib
-            import json
+        differences = (words >> np.uint64(1)).view(np.int64) ^ -(words & np.uint64(1)).view(np.int64)
+        return np.cumsum(differences, axis = 1) * steps[:, None]
+
+
+    def reserve_rows(buffer, used, needed, min_rows = 1024):
+        #return buffer if it has at least needed rows, or else a buffer with at least twice as
+        #many rows holding a copy of its first used rows, so that adding n rows one batch at a
+        #time copies O(n) rows in all
+
+        if needed <= len(buffer):
+            return buffer
+        grown = np.empty((max(2 * len(buffer), needed, min_rows),) + buffer.shape[1:])
+        grown[:used] = buffer[:used]
+        return grown
 
-            urlquery = urllib.parse.quote_plus(query, safe = '')
-            for element in corpora:
-                if element.corpus == corpus:
-                    corpusNumber = element.number
-                    break
-            url = 'http://books.google.com/ngrams/graph?content={:s}&year_start={:d}'.format(urlquery, startYear) \
-            + '&year_end={:d}&corpus={:d}&smoothing={:d}&share='.format(endYear, corpusNumber, smoothing)
 
+    def find_in_master_set(term, corpus, smoothing):
+        #find a term, corpus pair in the master list of ngrams already searched in the session
 
-            return_values = []
+        return ngrams_index.get((term, corpus, smoothing), [])
+
+
+    def add_to_master_set(ngram_object):
+        #returns True if the ngram was added, False if it was already in the master set
+        key = (ngram_object.name, ngram_object.corpus, ngram_object.smoothing)
+        with ngrams_lock:
+            if key in ngrams_index:
+                return False
+            ngrams.append(ngram_object)
+            ngrams_index[key] = ngram_object
+            return True
+
+
+    def read_ngram_log(file_name):
+        #add the ngrams recorded in the ngram log to the master set, so that terms searched in
+        #earlier sessions are not fetched again and can be compared with new searches
+
+        try:
+            with open(file_name) as ngrams_file:
+                for line in ngrams_file:
+                    #term, corpus, smoothing, label, data
+                    fields = line.rstrip('\n').split('\t')
+                    if len(fields) != 5:
+                        continue
+                    try:
+                        smoothing = int(fields[2])
+                        if fields[4].startswith('ces:'):
+                            data = decode_series(base64.b64decode(fields[4][4:]))[0]
+                        else:
+                            data = np.array(json.loads(fields[4]), dtype = float)
+                    except ValueError:
+                        continue
+                    add_to_master_set(NGram(fields[0], fields[1], smoothing, fields[3], data))
+                    ngrams_logged.setdefault(file_name, set()).add((fields[0], fields[1], smoothing))
+        except OSError:
+            pass
+
+
+    def getNgrams(query, corpus, startYear, endYear, smoothing):
+        #getNgrams py3 update adapted for plot_ngram_against()
+        #parse the query to format for url, convert the returned binary data to a
+        #string, and then find and return the ngram data as a list
+        #NB: in py3 urllib request read() returns binary data that must be decoded to utf-8
+
+        import urllib.parse
+        import urllib.request
+        import json
+
+        urlquery = urllib.parse.quote_plus(query, safe = '')
+        for element in corpora:
+            if element.corpus == corpus:
+                corpusNumber = element.number
+                break
+        url = 'http://books.google.com/ngrams/graph?content={:s}&year_start={:d}'.format(urlquery, startYear) \
+        + '&year_end={:d}&corpus={:d}&smoothing={:d}&share='.format(endYear, corpusNumber, smoothing)
+
+
+        return_values = []
+        try:
+            response_str = urllib.request.urlopen( url ).read().decode('utf-8')
+        except:
+            return_values = [0]
+
+
+        if not return_values:
+            pattern = ('(?<=var data = \[).*?}(?=\])')
+            var_data = re.findall(pattern, response_str)
+            data = json.loads(var_data[0])
+            return_values = data['timeseries']
+
+        return return_values
+
+
+    def fetch_ngram(term, corpus, smoothing, keep = True):
+        #return the ngram object for a term, corpus pair, making the url call only if it is not
+        #already in the master set; if another thread is already fetching the same pair, wait
+        #for that call rather than making a second one.  returns [] if no data was found
+        #ngrams retrieved from Google are first held only for this session, in ngrams_prefetched,
+        #and are added to the master set and the series store once they are fetched with keep
+        #(i.e. actually used), so half-typed terms that were prefetched are not stored
+
+        key = (term, corpus, smoothing)
+        with ngrams_lock:
+            found = find_in_master_set(term, corpus, smoothing) or ngrams_prefetched.get(key, [])
+            if not found:
+                pending = ngrams_fetching.get(key)
+                fetching = pending is None
+                if fetching:
+                    pending = ngrams_fetching[key] = threading.Event()
+
+        if not found and not fetching:
+            pending.wait()
+            with ngrams_lock:
+                found = find_in_master_set(term, corpus, smoothing) or ngrams_prefetched.get(key, [])
+        elif not found:
             try:
-                response_str = urllib.request.urlopen( url ).read().decode('utf-8')
-            except:
-                return_values = [0]
+                #ngrams fetched in earlier sessions are kept in the series store
+                found = series_store.get(term, corpus, smoothing)
+                if found:
+                    add_to_master_set(found)
+                else:
+                    #retrieved ngram data is always for 1900-2008, the plot settings only set the axes
+                    values = getNgrams(term, corpus, 1900, 2008, smoothing)
+                    if len(values) != 1:
+                        found = NGram(term, corpus, smoothing, '', np.array(values, dtype = float))
+                        found.set_label()
+                        with ngrams_lock:
+                            ngrams_prefetched[key] = found
+                            if len(ngrams_prefetched) > ngrams_prefetched_max:
+                                del ngrams_prefetched[next(iter(ngrams_prefetched))]
+            finally:
+                with ngrams_lock:
+                    del ngrams_fetching[key]
+                pending.set()
 
+        if found and keep:
+            #only the call that adds it to the master set stores it; ngrams from the store or
+            #the log are already in the master set
+            if add_to_master_set(found):
+                series_store.add(found)
+            with ngrams_lock:
+                ngrams_prefetched.pop(key, None)
+            return find_in_master_set(term, corpus, smoothing)
 
-            if not return_values:
-                pattern = ('(?<=var data = \[).*?}(?=\])')
-                var_data = re.findall(pattern, response_str)
-                data = json.loads(var_data[0])
-                return_values = data['timeseries']
+        return found
 
-            return return_values
-    
-    
-    
+
+    def fetch_ngrams(terms, languages, plot_settings):
         #search ngrams (list of ngrams created) for the term/corpus combinations queried
-        #if any of these searches are already present in ngrams, there is  no 
+        #if any of these searches are already present in ngrams, there is  no
         #need to make another url call to get that data
+        #if return for a query is [0], no ngram found & don't append data
+
+        not_found = []
+        successful_terms_corpora = [[], []]
+
         for word, corpus in zip(terms, languages):
-            if find_in_master_set(word, corpus): 
-                get = False
+            if fetch_ngram(word, corpus, plot_settings.smoothing):
                 successful_terms_corpora[0].append(word)
                 successful_terms_corpora[1].append(corpus)
             else:
-                get = True
-                
-            if get == True:
-                values = getNgrams(word, corpus, 1900, 2008, plot_settings.smoothing)
-                if len(values) == 1:
-                    not_found.append('\'' + word + '\' in ' + corpus)
+                not_found.append('\'' + word + '\' in ' + corpus)
+
+        return successful_terms_corpora, not_found
+
+
+    def scan_era(era, smoothing, count = 10, baseline = None, floor = 1e-9):
+        #rank the stored ngrams by how much their frequency changed inside an era of a background
+        #plot (a row of Timespan.dates: label, start year, [stage break,] end year) compared with a
+        #baseline window (start year, end year), by default as many years just before the era.
+        #the change is log2 of the ratio of the mean frequencies, with floor added to both so that
+        #very rare words do not dominate.  the ngrams in the master set are scanned in shards on
+        #every core, each shard keeping only its own top count; the rest of the series store is then
+        #scanned a block at a time, and all of the results are merged.
+        #returns (rising, falling) lists of (change, ngram object)
+        from concurrent.futures import ThreadPoolExecutor
+
+        era_start, era_end = max(era[1], 1900), min(era[-1], 2008)
+        if baseline is None:
+            length = era_end - era_start + 1
+            if era_start > 1900:
+                baseline = (era_start - length, era_start - 1)
+            else:
+                baseline = (era_end + 1, era_end + length)
+        base_start, base_end = max(baseline[0], 1900), min(baseline[1], 2008)
+        if era_start > era_end or base_start > base_end:
+            raise ValueError('the era and the baseline must both fall within 1900-2008')
+
+        objects, matrix = series_matrix.refresh(smoothing)
+        if count < 1:
+            return [], []
+
+        def top_changes(series):
+            #(change, row) of the count rows of series that rose and fell the most
+            #expressions such as (women-men) can be negative, so means are taken as at least 0
+            inside = np.maximum(series[:, era_start - 1900:era_end - 1900 + 1].mean(axis = 1), 0)
+            before = np.maximum(series[:, base_start - 1900:base_end - 1900 + 1].mean(axis = 1), 0)
+            change = np.log2((inside + floor) / (before + floor))
+
+            top = min(count, len(change))
+            rising = np.argpartition(-change, top - 1)[:top]
+            falling = np.argpartition(change, top - 1)[:top]
+            return [(change[row], row) for row in rising if change[row] > 0], \
+                   [(change[row], row) for row in falling if change[row] < 0]
+
+        def scan_shard(start):
+            rising, falling = top_changes(matrix[start:start + shard_rows])
+            return [(change, start + row, objects[start + row]) for change, row in rising], \
+                   [(change, start + row, objects[start + row]) for change, row in falling]
+
+        #(change, order found, ngram object), the order keeping ngrams with equal changes apart
+        rising, falling = [], []
+        if len(matrix) > 0:
+            #numpy releases the GIL for the work on each shard, so threads are enough to use every core
+            workers = os.cpu_count() or 1
+            shard_rows = max(65536, -(-len(matrix) // workers))
+            with ThreadPoolExecutor(max_workers = workers) as pool:
+                for shard_rising, shard_falling in pool.map(scan_shard, range(0, len(matrix), shard_rows)):
+                    rising += shard_rising
+                    falling += shard_falling
+
+        #then the stored ngrams not in the master set, a block at a time
+        found = itertools.count(len(matrix))
+        for rows, series in series_store.iterate(smoothing):
+            block_rising, block_falling = top_changes(series)
+            rising = heapq.nlargest(count, rising + [(change, next(found), NGram(*rows[row][0], rows[row][1], \
+                                                      series[row].copy())) for change, row in block_rising])
+            falling = heapq.nsmallest(count, falling + [(change, next(found), NGram(*rows[row][0], rows[row][1], \
+                                                        series[row].copy())) for change, row in block_falling])
+
+        return [(float(change), ngram_object) for change, order, ngram_object in heapq.nlargest(count, rising)], \
+               [(float(change), ngram_object) for change, order, ngram_object in heapq.nsmallest(count, falling)]
+
+
+    def set_max_min(terms, languages, plot_settings):
+        #set the y-axis max to be more than the greatest value in the data
+        #if data minimum < 0, set y-axis min to be less than the minimum
+        #value in the data by at least 10% of min value
+
+        maximum = 0.0
+        minimum = 0.0
+
+        x_start = plot_settings.start_year - 1900
+        x_end = plot_settings.end_year - 1900 + 1
+
+        for term, corpus in zip(terms, languages):
+            ngram_object = find_in_master_set(term, corpus, plot_settings.smoothing)
+            if max(ngram_object.data[x_start:x_end]) >= maximum:
+                maximum = max(ngram_object.data[x_start:x_end])
+            if min(ngram_object.data[x_start:x_end]) <= minimum:
+                minimum = min(ngram_object.data[x_start:x_end])
+
+        if abs(minimum) > abs(maximum):
+            margin = abs(minimum)/10
+        else:
+            margin = maximum/10
+        maximum += margin
+
+        if minimum != 0:
+            minimum -= margin
+
+        return minimum, maximum
+
+
+
+    def plotting(terms, languages, bck_plot_object, write_file_name, plot_settings, image_format = None, \
+                 compact_log = False):
+        #create plot if there is data to plot (i.e. at least one query returned ngram data)
+        #if an image_format ('png', 'svg') is given, return the rendered figure as bytes
+        #instead of showing it
+
+        import io
+        import matplotlib.axis as axis
+        from mpl_toolkits.axes_grid1 import make_axes_locatable
+
+        #log each plotted ngram once per log; ngrams read in from the log are not written again
+        if write_file_name:
+            logged = ngrams_logged.setdefault(write_file_name, set())
+            for term, corpus in zip(terms, languages):
+                ngram_object = find_in_master_set(term, corpus, plot_settings.smoothing)
+                key = (ngram_object.name, ngram_object.corpus, ngram_object.smoothing)
+                if key in logged:
+                    continue
+                #the data is written as a list of values, or compressed if compact_log
+                if compact_log:
+                    data_text = 'ces:' + base64.b64encode(encode_series([ngram_object.data], precision)).decode('ascii')
                 else:
-                    ngrams.append(NGram(word, corpus, plot_settings.smoothing, '', values))
-                    ngrams[-1].set_label()
-                    successful_terms_corpora[0].append(word)
-                    successful_terms_corpora[1].append(corpus)
-    
-    
+                    data_text = '{}'.format([float(value) for value in ngram_object.data])
+                try:
+                    with open(write_file_name, mode = 'a') as ngrams_file:
+                        ngrams_file.write(('{}\t{}\t').format(ngram_object.name, ngram_object.corpus) + \
+                                            '{}\t{}\t{}\n'.format(ngram_object.smoothing, ngram_object.label, data_text))
+                    logged.add(key)
+                except:
+                    pass
+
+        #the same plot inputs always render the same image, so only go through matplotlib
+        #if this figure is not already in the figure cache
+        if image_format:
+            figure_key = figure_cache.key(terms, languages, bck_plot_object, plot_settings, image_format)
+            cached_image = figure_cache.get(figure_key, image_format)
+            if cached_image:
+                return cached_image
+
+        plt.clf()
+
+        min_val, max_val = set_max_min(terms, languages, plot_settings)
+        plt.axis([plot_settings.start_year, plot_settings.end_year, min_val, max_val])
+
+
+        #plot the chosen background timespan info
+        main_plot = plt.subplot(1, 1, 1)
+        timespan_name = bck_plot_object.name
+        if timespan_name != 'none':
+            bck_plot_object.plot()
+            plt.subplots_adjust(bottom=0.17, right=0.76, top=0.92, left = 0.09)
+        else:
+            plt.axvspan(1900, 2008, color = 'grey', alpha = .2)
+            for year in range(1900, 2010, 5):
+                plt.axvline(year, color = 'white', alpha = .7)
+            plt.subplots_adjust(bottom=0.09, right=0.76, top=0.92, left = 0.09)
+
+
+        #if there is negative data, plot horizontal line at y = 0.0
+        if min_val < 0.0:
+            plt.axhline(0.0, color = 'black', alpha = .5, linewidth = 0.5)
+
+
+        #plot the data for the years 1900-2008
+        colors = ['black', 'blue', 'green', 'red', 'indigo']
+        for queried_term, queried_corpus, plot_color in zip(terms, languages, colors):
+            object_saved = find_in_master_set(queried_term, queried_corpus, plot_settings.smoothing)
+            plt.plot(range(1900, 2009), object_saved.data, label = object_saved.label, \
+                        color = plot_color, linewidth = 2.0)
+
+
+        #create title and legend for main plot
+        if timespan_name == 'none':
+            plt.title('Ngrams {}-{}'.format(plot_settings.start_year, plot_settings.end_year))
+        else:
+            plt.title('Ngrams and {}'.format(timespan_name))
+        plt.ylabel('% of ngrams')
+        plt.legend(bbox_to_anchor=(1.01, 1), loc=2, borderaxespad=0.2)
+
+
+        #if background data plotted, create bar with timespan info beneath main plot
+        if timespan_name != 'none':
+            divider = make_axes_locatable(main_plot)
+            box = divider.append_axes('bottom', size = '5%', pad=0.25)
+            bck_plot_object.plot()
+            box.axes.get_yaxis().set_visible(False)
+            tick_info = bck_plot_object.get_labels()
+            box.set_xticks(tick_info[1])
+            box.set_xticklabels(tick_info[0], rotation = 45, ha = 'right')
+            plt.axis([plot_settings.start_year, plot_settings.end_year, 0, 1])
+            box.tick_params(axis = u'both', which = u'both', length = 0)
+
+        if image_format:
+            image = io.BytesIO()
+            plt.savefig(image, format = image_format)
+            plt.close()
+            figure_cache.put(figure_key, image_format, image.getvalue())
+            return image.getvalue()
+
+        plt.show()
+
+
+
+    def plot_ngrams_against(terms, languages, bck_plot_object, write_file_name, plot_settings, compact_log = False):
+        #using ngram terms, chosen corpora, and background plot from GUI, determined
+        #if ngram data exists for the given entries, and if so plot it
+        #retrieved ngram data is for 1900-2008, smoothing 5
+        #delete term and corpus at the appropriate index in respective lists
+        #for queries that returned no data
+
+        successful_terms_corpora, not_found = fetch_ngrams(terms, languages, plot_settings)
+
+
         #if all ngrams have plottable data, plot & return 'none'
-        #else remove the corresponding words and corpora from the 
-        #lists so aren't produced in the plot figure, then plot ngram 
+        #else remove the corresponding words and corpora from the
+        #lists so aren't produced in the plot figure, then plot ngram
         #queries with data, and return those that didn't have data to plot
-        
+
         if len(successful_terms_corpora[0]) == 0:
             success = not_found
         elif len(not_found) > 0:
             plotting(successful_terms_corpora[0], successful_terms_corpora[1], bck_plot_object, write_file_name, \
-                    plot_settings)
+                    plot_settings, compact_log = compact_log)
             success = not_found
         else:
             plotting(successful_terms_corpora[0], successful_terms_corpora[1], bck_plot_object, write_file_name, \
-                    plot_settings)
+                    plot_settings, compact_log = compact_log)
             success = 'none'
-            
+
         return(success)
-    
-    
-    
-    root = tk.Tk()
-    gui = Application(root)
-    root.mainloop()
-    
-    
+
+
+
+    class NgramServer (object):
+        def __init__ (self, port = 8155, host = '127.0.0.1', timespan_file = 'timespan_data.tsv', \
+                      fetch_workers = 8, max_requests = 32, miss_expiry = 600, read_timeout = 10, max_headers = 100):
+            #local http service answering with ngram series as json and rendered plots as png/svg, so
+            #that any number of clients share the one master set of ngrams instead of each fetching
+            #the same data from Google
+            from concurrent.futures import ThreadPoolExecutor
+
+            self.host = host
+            self.port = port
+            self.timespan_objects = read_timespans(timespan_file)
+            self.max_requests = max_requests
+            self.fetch_pool = ThreadPoolExecutor(max_workers = fetch_workers)
+            #pyplot draws on a single global figure, so plots are rendered one at a time
+            self.render_pool = ThreadPoolExecutor(max_workers = 1)
+            #ngrams with no data are remembered too (key -> time of the failed fetch), so they are
+            #not asked for again until miss_expiry seconds have passed
+            self.missing = {}
+            self.miss_expiry = miss_expiry
+            #a client gets read_timeout seconds to send its request line and at most max_headers
+            #header lines, so idle or slow connections do not pile up
+            self.read_timeout = read_timeout
+            self.max_headers = max_headers
+            self.content_types = {'json': 'application/json', 'text': 'text/plain; charset=utf-8', \
+                                  'png': 'image/png', 'svg': 'image/svg+xml'}
+            self.reasons = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found', \
+                            405: 'Method Not Allowed', 408: 'Request Timeout', 500: 'Internal Server Error'}
+
+
+        def run(self):
+            asyncio.run(self.serve())
+
+
+        async def serve(self):
+            #requests beyond max_requests wait for a free slot before any fetching or rendering starts
+            self.slots = asyncio.Semaphore(self.max_requests)
+            server = await asyncio.start_server(self.handle, self.host, self.port)
+            print('Culturomics Explorer serving on http://{}:{}'.format(self.host, self.port))
+            async with server:
+                await server.serve_forever()
+
+
+        async def handle(self, reader, writer):
+            #read a single request, answer it, and close the connection
+
+            try:
+                request_line = []
+                headers = {}
+                error = None
+                try:
+                    request_line, headers = await asyncio.wait_for(self.read_request(reader), self.read_timeout)
+                except asyncio.TimeoutError:
+                    error = 408, 'text', b'request not received in time'
+                except ValueError as reading_error:
+                    error = 400, 'text', str(reading_error).encode('utf-8')
+
+                if error:
+                    status, kind, body = error
+                elif len(request_line) != 3:
+                    status, kind, body = 400, 'text', b'malformed request'
+                elif request_line[0] not in ('GET', 'HEAD'):
+                    status, kind, body = 405, 'text', b'only GET and HEAD are supported'
+                else:
+                    async with self.slots:
+                        status, kind, body = await self.respond(request_line[1])
+
+                #the etag is a hash of the response content, so identical plots or series
+                #are answered with 304 when the client already has them
+                etag = '"{}"'.format(hashlib.sha256(body).hexdigest()[:32])
+                if status == 200 and self.etag_matches(headers.get('if-none-match', ''), etag):
+                    status = 304
+
+                response_headers = ['HTTP/1.1 {} {}'.format(status, self.reasons[status]), \
+                                    'Content-Type: {}'.format(self.content_types[kind]), \
+                                    'ETag: {}'.format(etag), 'Cache-Control: no-cache', 'Connection: close']
+                #a HEAD response has the length the GET response would have, but no body
+                if status == 304:
+                    body = b''
+                response_headers.append('Content-Length: {}'.format(len(body)))
+                if request_line[:1] == ['HEAD']:
+                    body = b''
+                writer.write(('\r\n'.join(response_headers) + '\r\n\r\n').encode('latin-1') + body)
+                await writer.drain()
+            except ConnectionError:
+                pass
+            finally:
+                writer.close()
+
+
+        async def read_request(self, reader):
+            #the words of the request line, and the headers by lower case name
+            request_line = (await reader.readline()).decode('latin-1').split()
+            headers = {}
+            header_lines = 0
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                header_lines += 1
+                if header_lines > self.max_headers:
+                    raise ValueError('too many header lines')
+                name, separator, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            return request_line, headers
+
+
+        def etag_matches(self, if_none_match, etag):
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return '*' in tags or etag in tags or 'W/' + etag in tags
+
+
+        async def respond(self, target):
+            #route the request path; returns (status, content kind, body bytes)
+            from urllib.parse import urlsplit, parse_qs
+
+            url = urlsplit(target)
+            query = parse_qs(url.query)
+            try:
+                if url.path == '/timespans':
+                    names = [timespan.name for timespan in self.timespan_objects]
+                    return 200, 'json', json.dumps(names).encode('utf-8')
+                elif url.path == '/series':
+                    return await self.series(query)
+                elif url.path in ('/plot.png', '/plot.svg'):
+                    return await self.plot(query, url.path[-3:])
+                elif url.path == '/similar':
+                    return await self.similar(query)
+                elif url.path == '/era':
+                    return await self.era(query)
+                else:
+                    return 404, 'text', 'no such endpoint: {}'.format(url.path).encode('utf-8')
+            except ValueError as error:
+                return 400, 'text', str(error).encode('utf-8')
+            except Exception as error:
+                return 500, 'text', repr(error).encode('utf-8')
+
+
+        def read_query(self, query):
+            #translate the query string into the same arguments the GUI passes to plot_ngrams_against:
+            #up to five term=..., optional matching corpus=..., start, end, smoothing and background
+
+            terms = []
+            for term in query.get('term', []):
+                #terms left empty once the unsearchable characters are removed are dropped
+                if len(term.strip()) > 0 and len(validate_term(term)[0]) > 0:
+                    terms.append(validate_term(term)[0])
+            if len(terms) == 0:
+                raise ValueError('nothing entered to search')
+            if len(terms) > 5:
+                raise ValueError('at most 5 terms can be plotted together')
+
+            corpus_names = [element.corpus for element in corpora]
+            languages = query.get('corpus', [])[:len(terms)]
+            languages += ['eng_us_2012'] * (len(terms) - len(languages))
+            for corpus in languages:
+                if corpus not in corpus_names:
+                    raise ValueError('unknown corpus \'{}\''.format(corpus))
+
+            plot_settings = make_plot_settings(int(query.get('start', ['1900'])[0]), \
+                                               int(query.get('end', ['2008'])[0]), \
+                                               int(query.get('smoothing', ['5'])[0]))
+
+            bck_plot = query.get('background', ['none'])[0]
+            options_list = [timespan.name for timespan in self.timespan_objects]
+            if bck_plot not in options_list:
+                raise ValueError('unknown background plot \'{}\''.format(bck_plot))
+            bck_plot_object = self.timespan_objects[options_list.index(bck_plot)]
+
+            return terms, languages, plot_settings, bck_plot_object
+
+
+        async def fetch(self, terms, languages, plot_settings):
+            #fetch all queried ngrams concurrently on the fetch pool, except those that recently had no data
+            #returns the ngram object (or [] if no data) for each query, and the queries with no data
+            loop = asyncio.get_running_loop()
+            now = loop.time()
+            keys = [(term, corpus, plot_settings.smoothing) for term, corpus in zip(terms, languages)]
+            fetched = [now - self.missing.get(key, now - self.miss_expiry) >= self.miss_expiry for key in keys]
+
+            async def fetch_one(key, fetching):
+                if not fetching:
+                    return []
+                return await loop.run_in_executor(self.fetch_pool, fetch_ngram, *key)
+
+            found = await asyncio.gather(*[fetch_one(key, fetching) for key, fetching in zip(keys, fetched)])
+            not_found = []
+            for key, fetching, ngram_object in zip(keys, fetched, found):
+                if ngram_object:
+                    self.missing.pop(key, None)
+                else:
+                    if fetching:
+                        self.missing[key] = now
+                    not_found.append('\'' + key[0] + '\' in ' + key[1])
+            return found, not_found
+
+
+        async def series(self, query):
+            terms, languages, plot_settings, bck_plot_object = self.read_query(query)
+            found, not_found = await self.fetch(terms, languages, plot_settings)
+
+            x_start = plot_settings.start_year - 1900
+            x_end = plot_settings.end_year - 1900 + 1
+            series = []
+            for term, corpus, ngram_object in zip(terms, languages, found):
+                if ngram_object:
+                    series.append({'term': term, 'corpus': corpus, 'label': ngram_object.label, \
+                                   'years': list(range(plot_settings.start_year, plot_settings.end_year + 1)), \
+                                   'values': [float(value) for value in ngram_object.data[x_start:x_end]]})
+
+            content = {'start year': plot_settings.start_year, 'end year': plot_settings.end_year, \
+                       'smoothing': plot_settings.smoothing, 'series': series, 'not found': not_found}
+            return 200, 'json', json.dumps(content).encode('utf-8')
+
+
+        async def plot(self, query, image_format):
+            terms, languages, plot_settings, bck_plot_object = self.read_query(query)
+            found, not_found = await self.fetch(terms, languages, plot_settings)
+
+            successful_terms_corpora = [[], []]
+            for term, corpus, ngram_object in zip(terms, languages, found):
+                if ngram_object:
+                    successful_terms_corpora[0].append(term)
+                    successful_terms_corpora[1].append(corpus)
+
+            if len(successful_terms_corpora[0]) == 0:
+                return 404, 'text', 'no data found for {}'.format(', '.join(not_found)).encode('utf-8')
+
+            #the server keeps no ngram log
+            loop = asyncio.get_running_loop()
+            image = await loop.run_in_executor(self.render_pool, plotting, successful_terms_corpora[0], \
+                                               successful_terms_corpora[1], bck_plot_object, None, \
+                                               plot_settings, image_format)
+            return 200, image_format, image
+
+
+        async def similar(self, query):
+            #the stored ngrams whose usage over the window most resembles that of the first term;
+            #also takes 'measure' (correlation, euclidean or dtw) and 'count' (default 10)
+            terms, languages, plot_settings, bck_plot_object = self.read_query(query)
+            measure = query.get('measure', ['correlation'])[0]
+            count = int(query.get('count', ['10'])[0])
+            if measure not in ('correlation', 'euclidean', 'dtw'):
+                raise ValueError('unknown distance measure \'{}\''.format(measure))
+
+            found, not_found = await self.fetch(terms[:1], languages[:1], plot_settings)
+            if not_found:
+                return 404, 'text', 'no data found for {}'.format(not_found[0]).encode('utf-8')
+
+            loop = asyncio.get_running_loop()
+            neighbours = await loop.run_in_executor(self.fetch_pool, trajectory_index.search, found[0], \
+                                                    plot_settings, count, measure)
+            content = [{'term': ngram_object.name, 'corpus': ngram_object.corpus, 'label': ngram_object.label, \
+                        'distance': distance} for distance, ngram_object in neighbours]
+            return 200, 'json', json.dumps(content).encode('utf-8')
+
+
+        async def era(self, query):
+            #the stored ngrams that rose and fell the most during an era of a background plot:
+            #'background' and 'era' name the plot and the era, and 'count', 'smoothing',
+            #'baseline_start' and 'baseline_end' are optional
+            bck_plot = query.get('background', ['none'])[0]
+            options_list = [timespan.name for timespan in self.timespan_objects]
+            if bck_plot not in options_list[1:]:
+                raise ValueError('unknown background plot \'{}\''.format(bck_plot))
+            eras = self.timespan_objects[options_list.index(bck_plot)].dates[1:]
+            era_labels = [era[0] for era in eras]
+            era_label = query.get('era', [''])[0]
+            if era_label not in era_labels:
+                raise ValueError('unknown era \'{}\' in \'{}\''.format(era_label, bck_plot))
+
+            baseline = None
+            if 'baseline_start' in query and 'baseline_end' in query:
+                baseline = (int(query['baseline_start'][0]), int(query['baseline_end'][0]))
+
+            loop = asyncio.get_running_loop()
+            rising, falling = await loop.run_in_executor(self.fetch_pool, scan_era, eras[era_labels.index(era_label)], \
+                                                         int(query.get('smoothing', ['5'])[0]), \
+                                                         int(query.get('count', ['10'])[0]), baseline)
+            content = {}
+            for direction, ranked in zip(['rising', 'falling'], [rising, falling]):
+                content[direction] = [{'term': ngram_object.name, 'corpus': ngram_object.corpus, \
+                                       'label': ngram_object.label, 'change': change} \
+                                      for change, ngram_object in ranked]
+            return 200, 'json', json.dumps(content).encode('utf-8')
+
+
+
+    def read_batch_jobs(jobs_file, timespan_names):
+        #each line of the jobs file is a plot: the output file (.png or .svg), the background plot,
+        #the start year, end year and smoothing, then up to five ngrams, each followed by its
+        #corpus, all separated by tabs.  blank cells take the GUI's defaults
+        jobs = []
+        with open(jobs_file) as jobs_data:
+            for line_number, line in enumerate(jobs_data, 1):
+                cells = line.rstrip('\n').split('\t')
+                if len(line.strip()) == 0:
+                    continue
+                cells += [''] * (7 - len(cells))
+                output, bck_plot, start, end, smooth = cells[:5]
+
+                if not output.endswith(('.png', '.svg')):
+                    raise ValueError('line {}: output file must end in .png or .svg'.format(line_number))
+                bck_plot = bck_plot or 'none'
+                if bck_plot not in timespan_names:
+                    raise ValueError('line {}: unknown background plot \'{}\''.format(line_number, bck_plot))
+
+                terms, languages = [], []
+                for term, corpus in zip(cells[5::2], cells[6::2] + ['']):
+                    if len(term.strip()) > 0 and len(validate_term(term)[0]) > 0:
+                        terms.append(validate_term(term)[0])
+                        languages.append(corpus or 'eng_us_2012')
+                if len(terms) == 0 or len(terms) > 5:
+                    raise ValueError('line {}: a plot needs 1 to 5 ngrams'.format(line_number))
+                for corpus in languages:
+                    if corpus not in [element.corpus for element in corpora]:
+                        raise ValueError('line {}: unknown corpus \'{}\''.format(line_number, corpus))
+
+                plot_settings = make_plot_settings(int(start or 1900), int(end or 2008), int(smooth or 5))
+                jobs.append((output, bck_plot, plot_settings.start_year, plot_settings.end_year, \
+                             plot_settings.smoothing, terms, languages))
+        return jobs
+
+
+    def key_record(ngram_object):
+        #the key of an ngram as stored in a SharedSeriesStore
+        return '{}\t{}\t{}\t{}\n'.format(ngram_object.name, ngram_object.corpus, ngram_object.smoothing, \
+                                         ngram_object.label).encode('utf-8')
+
+
+    def render_batch_jobs(worker, jobs, results, store, requests, replies, timespan_objects):
+        #worker process: take jobs until a None job arrives.  the data of every ngram comes from
+        #the shared store (asking the coordinator for any that are missing), so the worker's own
+        #master set only holds views of the shared memory
+        timespan_names = [timespan.name for timespan in timespan_objects]
+
+        def load(term, corpus, smoothing):
+            found = store.get(term, corpus, smoothing)
+            if not found:
+                requests.put((worker, term, corpus, smoothing))
+                stored, error = replies.get()
+                if error:
+                    raise RuntimeError('\'{}\' in {}: {}'.format(term, corpus, error))
+                if stored:
+                    found = store.get(term, corpus, smoothing)
+            return found
+
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+            output, bck_plot, start, end, smooth, terms, languages = job
+            plot_settings = PlotSettings(start, end, smooth)
+
+            try:
+                successful_terms_corpora = [[], []]
+                not_found = []
+                for term, corpus in zip(terms, languages):
+                    ngram_object = load(term, corpus, smooth)
+                    if ngram_object:
+                        add_to_master_set(ngram_object)
+                        successful_terms_corpora[0].append(term)
+                        successful_terms_corpora[1].append(corpus)
+                    else:
+                        not_found.append('\'' + term + '\' in ' + corpus)
+
+                if len(successful_terms_corpora[0]) > 0:
+                    image = plotting(successful_terms_corpora[0], successful_terms_corpora[1], \
+                                     timespan_objects[timespan_names.index(bck_plot)], None, plot_settings, \
+                                     output[-3:])
+                    with open(output, mode = 'wb') as image_file:
+                        image_file.write(image)
+                results.put((output, len(successful_terms_corpora[0]) > 0, not_found, None))
+            except Exception as error:
+                results.put((output, False, [], repr(error)))
+
+
+    def run_batch(jobs_file, workers = None):
+        #render the plots listed in jobs_file on a pool of worker processes that share one
+        #store of ngram data; workers are forked, as the classes and functions here are local
+        #to culturomics_explorer and cannot be pickled
+        import multiprocessing
+        import queue
+
+        timespan_objects = read_timespans('timespan_data.tsv')
+        jobs = read_batch_jobs(jobs_file, [timespan.name for timespan in timespan_objects])
+        if len(jobs) == 0:
+            return
+        workers = min(workers or os.cpu_count() or 1, len(jobs))
+
+        ngram_keys = set()
+        for job in jobs:
+            for term, corpus in zip(job[5], job[6]):
+                ngram_keys.add((term, corpus, job[4]))
+
+        #room for the key of each ngram with the label it is given when fetched or, if longer,
+        #the label it has in the ngram log (only the labels are read from the log here)
+        labels = {}
+        for term, corpus, smoothing in ngram_keys:
+            ngram_object = NGram(term, corpus, smoothing)
+            ngram_object.set_label()
+            labels[(term, corpus, smoothing)] = ngram_object.label
+        try:
+            with open('ngrams_data.tsv') as ngrams_file:
+                for line in ngrams_file:
+                    fields = line.split('\t')
+                    if len(fields) == 5 and fields[2].strip().isdigit():
+                        key = (fields[0], fields[1], int(fields[2]))
+                        if key in labels and len(fields[3]) > len(labels[key]):
+                            labels[key] = fields[3]
+        except OSError:
+            pass
+        keys_capacity = sum(len(key_record(NGram(key[0], key[1], key[2], label))) for key, label in labels.items())
+
+        context = multiprocessing.get_context('fork')
+        store = SharedSeriesStore(len(ngram_keys), keys_capacity)
+        processes = []
+        coordinator_thread = None
+        #whatever happens (an error, ctrl-c), the coordinator is stopped, the workers are ended and
+        #the shared memory is freed
+        try:
+            coordinator = SeriesCoordinator(store, context, workers)
+            job_queue = context.Queue()
+            results = context.Queue()
+            processes = [context.Process(target = render_batch_jobs, args = (worker, job_queue, results, store, \
+                                                                             coordinator.requests, \
+                                                                             coordinator.replies[worker], \
+                                                                             timespan_objects)) \
+                         for worker in range(workers)]
+            for process in processes:
+                process.start()
+
+            #start the coordinator only after forking, so no worker inherits its threads' locks
+            read_ngram_log('ngrams_data.tsv')
+            coordinator_thread = threading.Thread(target = coordinator.serve)
+            coordinator_thread.start()
+
+            for job in jobs:
+                job_queue.put(job)
+            for process in processes:
+                job_queue.put(None)
+
+            finished = 0
+            while finished < len(jobs):
+                try:
+                    output, written, not_found, error = results.get(timeout = 1)
+                except queue.Empty:
+                    if any(process.is_alive() for process in processes):
+                        continue
+                    #every worker has stopped, so whatever they sent has arrived by now
+                    try:
+                        output, written, not_found, error = results.get(timeout = 1)
+                    except queue.Empty:
+                        print('{} plots were not drawn, as the worker processes stopped'.format(len(jobs) - finished))
+                        break
+                finished += 1
+
+                if error:
+                    print('{}: failed, {}'.format(output, error))
+                elif not written:
+                    print('{}: no data found for {}'.format(output, ', '.join(not_found)))
+                elif len(not_found) > 0:
+                    print('{}: written, no data found for {}'.format(output, ', '.join(not_found)))
+                else:
+                    print('{}: written'.format(output))
+        finally:
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+                if process.pid is not None:
+                    process.join()
+            if coordinator_thread is not None:
+                coordinator.requests.put(None)
+                coordinator_thread.join()
+            store.close()
+
+
+    def run_checks():
+        #check the compression of ngram data, the series store, the similarity search and the era
+        #scan against known answers, printing a line per check; returns the number of checks that failed
+        nonlocal series_store
+        failures = []
+
+        def check(description, passed):
+            print('{}  {}'.format('ok  ' if passed else 'FAIL', description))
+            if not passed:
+                failures.append(description)
+
+        #frequencies of very different sizes, and series that are flat, zero or negative (as an
+        #expression such as (women-men) can be)
+        random = np.random.default_rng(155)
+        years = np.linspace(0, 1, 109)
+        matrix = np.array([10 ** random.uniform(-10, -3) * (1.5 + np.sin(random.uniform(1, 12) * years + \
+                                                                         random.uniform(0, 6))) for row in range(60)] + \
+                          [np.zeros(109), np.full(109, 3e-7), -np.linspace(0, 1e-6, 109), random.normal(0, 1e-6, 109)])
+
+        check('exact compression gives back every value bit for bit', \
+              decode_series(encode_series(matrix)).tobytes() == matrix.tobytes())
+        check('a single series is compressed as a block of one', \
+              decode_series(encode_series(matrix[5])).tobytes() == matrix[5:6].tobytes())
+        for precision in (1e-2, 1e-4, 1e-6):
+            decoded = decode_series(encode_series(matrix, precision))
+            error = np.abs(decoded - matrix).max(axis = 1)
+            bound = 0.5 * precision * np.abs(matrix).max(axis = 1) * (1 + 1e-9)
+            check('precision {}: no value is off by more than half of precision * the largest value of its series' \
+                  .format(precision), decoded.shape == matrix.shape and (error <= bound).all())
+
+        encoded = encode_series(matrix)
+        for description, corrupt in [('empty', b''), ('truncated', encoded[:-5]), ('not compressed', bytes(40))]:
+            try:
+                decode_series(corrupt)
+                check('{} data is rejected'.format(description), False)
+            except ValueError:
+                check('{} data is rejected'.format(description), True)
+
+        def stored(store, rows):
+            #whether the store gives back exactly the series of these rows of the matrix
+            for row in rows:
+                ngram_object = store.get('check {}'.format(row), 'eng_2012', 3)
+                if not ngram_object or ngram_object.data.tobytes() != matrix[row].tobytes():
+                    return False
+            return True
+
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = os.path.join(directory, 'ngrams_cache.dat')
+            store = SeriesStoreFile(file_name, block_rows = 4)
+            for row in range(10):
+                store.add(NGram('check {}'.format(row), 'eng_2012', 3, 'check', matrix[row]))
+            store.add(NGram('short', 'eng_2012', 3, 'short', np.ones(50)))
+            store.flush()
+            check('a reopened store gives back every series', stored(SeriesStoreFile(file_name), range(10)))
+            check('series not covering 1900-2008 are not stored', SeriesStoreFile(file_name).get('short', 'eng_2012', 3) == [])
+            check('the store is read through a batch at a time', \
+                  [len(keys) for keys, series in SeriesStoreFile(file_name).iterate(3, batch_rows = 5)] == [8, 2])
+
+            #a block left unfinished by a session that stopped while writing its data
+            keys = json.dumps([['check 10', 'eng_2012', 3, 'check']]).encode('utf-8')
+            data = encode_series(matrix[10])
+            with open(file_name, mode = 'ab') as store_file:
+                store_file.write(struct.pack('<4sII', b'CES1', len(keys), len(data)) + keys + data[:len(data) // 2])
+            store = SeriesStoreFile(file_name, block_rows = 1)
+            check('an unfinished block is ignored', len(store.blocks) == 3 and stored(store, range(10)) and \
+                                                    store.get('check 10', 'eng_2012', 3) == [])
+            store.add(NGram('check 10', 'eng_2012', 3, 'check', matrix[10]))
+            check('the next block written replaces an unfinished one', stored(SeriesStoreFile(file_name), range(11)))
+
+            #a complete block whose keys cannot be read, followed by a good one
+            data = encode_series(matrix[:2])
+            with open(file_name, mode = 'ab') as store_file:
+                store_file.write(struct.pack('<4sII', b'CES1', 8, len(data)) + b'not json' + data)
+            SeriesStoreFile(file_name, block_rows = 1).add(NGram('check 11', 'eng_2012', 3, 'check', matrix[11]))
+            check('a block whose keys cannot be read is skipped', stored(SeriesStoreFile(file_name), range(12)))
+
+        #the similarity search and era scan, over series half in the master set and half only in a
+        #series store of their own, against comparing the query with every series in turn
+        positive = np.abs(matrix[:60])
+        names = ['similar {}'.format(row) for row in range(60)]
+        saved_store = series_store
+        with tempfile.TemporaryDirectory() as directory:
+            series_store = SeriesStoreFile(os.path.join(directory, 'ngrams_cache.dat'), block_rows = 16)
+            try:
+                for row in range(60):
+                    if row < 30:
+                        add_to_master_set(NGram(names[row], 'eng_2012', 3, names[row], positive[row]))
+                    else:
+                        series_store.add(NGram(names[row], 'eng_2012', 3, names[row], positive[row]))
+                #a stored copy of an ngram in the master set is not compared (this one, with the
+                #query's data, would otherwise be the closest)
+                series_store.add(NGram(names[1], 'eng_2012', 3, names[1], positive[0]))
+                series_store.flush()
+
+                plot_settings = PlotSettings(1910, 2000, 3)
+                window = trajectory_index.z_normalize(positive[:, 10:101])
+                query = window[0]
+                expected_distances = {'correlation': 1.0 - window.dot(query) / len(query), \
+                                      'euclidean': np.sqrt(((window - query) ** 2).sum(axis = 1)), \
+                                      'dtw': trajectory_index.dtw(query, window, len(query) // 10)}
+                for measure, distances in expected_distances.items():
+                    expected = [row for row in np.argsort(distances) if row != 0][:5]
+                    found = trajectory_index.search(find_in_master_set(names[0], 'eng_2012', 3), plot_settings, 5, measure)
+                    check('{} search finds the same closest ngrams as comparing every series'.format(measure), \
+                          [ngram_object.name for distance, ngram_object in found] == [names[row] for row in expected] and \
+                          np.allclose([distance for distance, ngram_object in found], distances[expected]))
+                try:
+                    trajectory_index.search(find_in_master_set(names[0], 'eng_2012', 3), plot_settings, 0)
+                    check('a search for fewer than 1 ngram is refused', False)
+                except ValueError:
+                    check('a search for fewer than 1 ngram is refused', True)
+
+                inside = positive[:, 30:40].mean(axis = 1)
+                before = positive[:, 20:30].mean(axis = 1)
+                changes = np.log2((inside + 1e-9) / (before + 1e-9))
+                rising, falling = scan_era(['check', 1930, 1939], 3, 5)
+                check('era scan finds the same rising and falling ngrams as comparing every series', \
+                      [ngram_object.name for change, ngram_object in rising] == \
+                      [names[row] for row in np.argsort(-changes)[:5] if changes[row] > 0] and \
+                      [ngram_object.name for change, ngram_object in falling] == \
+                      [names[row] for row in np.argsort(changes)[:5] if changes[row] < 0])
+            finally:
+                series_store = saved_store
+
+        return len(failures)
+
+
+
+    if mode == 'serve':
+        read_ngram_log('ngrams_data.tsv')
+        NgramServer(port).run()
+    elif mode == 'batch':
+        #the log is read once the workers have started, so they do not inherit the master set
+        run_batch(jobs_file, workers)
+    elif mode == 'check':
+        return run_checks()
+    else:
+        read_ngram_log('ngrams_data.tsv')
+        import tkinter as tk
+        from tkinter import filedialog as fd
+        from tkinter import ttk
+
+        root = tk.Tk()
+        gui = Application(root)
+        root.mainloop()
+
+
 if __name__ == '__main__':
-    culturomics_explorer()
+    #'python culturomics_explorer.py serve [port]' runs the local http service instead of the GUI,
+    #'python culturomics_explorer.py batch jobs_file [workers]' renders the plots listed in jobs_file,
+    #'python culturomics_explorer.py check' runs the program's self-checks,
+    #and any of these can be followed by '--precision 0.0001' to store ngram data rounded to that precision
+    import sys
+    arguments = sys.argv[1:]
+    precision = None
+    if '--precision' in arguments[:-1]:
+        precision = float(arguments.pop(arguments.index('--precision') + 1))
+        arguments.remove('--precision')
+    if len(arguments) > 0 and arguments[0] == 'serve':
+        culturomics_explorer('serve', *[int(arg) for arg in arguments[1:2]], precision = precision)
+    elif len(arguments) > 1 and arguments[0] == 'batch':
+        culturomics_explorer('batch', jobs_file = arguments[1], workers = int(arguments[2]) if len(arguments) > 2 else None, \
+                             precision = precision)
+    elif len(arguments) > 0 and arguments[0] == 'check':
+        sys.exit(1 if culturomics_explorer('check', precision = precision) else 0)
+    else:
+        culturomics_explorer(precision = precision)